@@ -1,6 +1,8 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, g, current_app, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, g, current_app, jsonify, send_from_directory
 from auth import login_required
 from datetime import datetime
+import profiler
+import memory_profile
 from forms import PlatformSettingForm, CategoryForm, ServiceEditForm, FlagForm, AdminNoteForm, ReviewModerationForm
 import json
 
@@ -84,14 +86,9 @@ def dashboard():
                             key=lambda x: x.get('payment_date', ''), reverse=True)[:10]
     
     # Service popularity
-    service_popularity = {}
-    for category in categories:
-        if category.get('is_active', True):
-            category_services = [s for s in services if s['category_id'] == category['id']]
-            category_bookings = 0
-            for service in category_services:
-                category_bookings += len([b for b in bookings if b['service_id'] == service['id']])
-            service_popularity[category['category_name']] = category_bookings
+    category_bookings = current_app.popularity.category_bookings()
+    service_popularity = {category['category_name']: category_bookings.get(category['id'], 0)
+                          for category in categories if category.get('is_active', True)}
     
     metrics = {
         'total_users': total_users,
@@ -552,11 +549,10 @@ def manage_services():
         services = [s for s in services if search_query in s.get('service_name', '').lower()]
     
     # Enrich with provider info
-    for service in services:
-        provider = db.get_by_id('Users', service.get('provider_id'))
-        category = db.get_by_id('Service_Categories', service.get('category_id'))
-        service['provider_name'] = provider.get('name') if provider else 'Unknown'
-        service['category_name'] = category.get('category_name') if category else 'Unknown'
+    db.load_related(services, {
+        'provider_name': ('Users', 'provider_id', 'name', 'Unknown'),
+        'category_name': ('Service_Categories', 'category_id', 'category_name', 'Unknown')
+    })
     
     return render_template('admin/services.html', services=services, categories=categories)
 
@@ -701,9 +697,7 @@ def manage_categories():
         category['service_count'] = len([s for s in all_services if s['category_id'] == category['id']])
     
     # Get requester info for pending requests
-    for request in pending_requests:
-        requester = db.get_by_id('Users', request.get('requested_by'))
-        request['requester_name'] = requester['name'] if requester else 'Unknown'
+    db.load_related(pending_requests, {'requester_name': ('Users', 'requested_by', 'name', 'Unknown')})
     
     return render_template('admin/categories.html', categories=categories, pending_requests=pending_requests)
 
@@ -818,13 +812,11 @@ def manage_bookings():
         bookings = [b for b in bookings if search_query in str(b.get('id', ''))]
     
     # Enrich with user and service info
-    for booking in bookings:
-        user = db.get_by_id('Users', booking['user_id'])
-        provider = db.get_by_id('Users', booking['provider_id'])
-        service = db.get_by_id('Services', booking['service_id'])
-        booking['user_name'] = user.get('name') if user else 'Unknown'
-        booking['provider_name'] = provider.get('name') if provider else 'Unknown'
-        booking['service_name'] = service.get('service_name') if service else 'Unknown'
+    db.load_related(bookings, {
+        'user_name': ('Users', 'user_id', 'name', 'Unknown'),
+        'provider_name': ('Users', 'provider_id', 'name', 'Unknown'),
+        'service_name': ('Services', 'service_id', 'service_name', 'Unknown')
+    })
     
     # Sort by booking date (newest first)
     bookings.sort(key=lambda x: x.get('booking_date', ''), reverse=True)
@@ -907,11 +899,10 @@ def manage_reviews():
         reviews = [r for r in reviews if r.get('is_flagged', False)]
     
     # Enrich with user and provider info
-    for review in reviews:
-        user = db.get_by_id('Users', review['user_id'])
-        provider = db.get_by_id('Users', review['provider_id'])
-        review['user_name'] = user.get('name') if user else 'Unknown'
-        review['provider_name'] = provider.get('name') if provider else 'Unknown'
+    db.load_related(reviews, {
+        'user_name': ('Users', 'user_id', 'name', 'Unknown'),
+        'provider_name': ('Users', 'provider_id', 'name', 'Unknown')
+    })
     
     reviews.sort(key=lambda x: x.get('created_at', ''), reverse=True)
     
@@ -1034,9 +1025,7 @@ def support_tickets():
     tickets.sort(key=lambda x: x.get('created_at', ''), reverse=True)
     
     # Enrich with user information
-    for ticket in tickets:
-        user = db.get_by_id('Users', ticket.get('user_id'))
-        ticket['user'] = user
+    db.load_related(tickets, {'user': ('Users', 'user_id')})
     
     return render_template('admin/support.html', tickets=tickets)
 
@@ -1317,7 +1306,6 @@ def analytics():
     bookings = db.get_all('Bookings')
     payments = db.get_all('Payments')
     categories = db.get_all('Service_Categories')
-    reviews = db.get_all('Reviews')
     
     # User analytics
     user_stats = {
@@ -1374,14 +1362,20 @@ def analytics():
     }
     
     # Service popularity by category
-    service_popularity = {}
-    for category in categories:
-        if category.get('is_active', True):
-            category_services = [s for s in services if s['category_id'] == category['id']]
-            category_bookings = 0
-            for service in category_services:
-                category_bookings += len([b for b in bookings if b['service_id'] == service['id']])
-            service_popularity[category['category_name']] = category_bookings
+    category_bookings = current_app.popularity.category_bookings()
+    service_popularity = {category['category_name']: category_bookings.get(category['id'], 0)
+                          for category in categories if category.get('is_active', True)}
+    
+    # Most popular services, read off the popularity ranking
+    popular_services = []
+    for service_id in current_app.popularity.top(10):
+        listing = current_app.catalog.get(service_id)
+        if listing:
+            popular_services.append({
+                'name': listing.get('service_name'),
+                'category': listing['category_name'],
+                'score': round(current_app.popularity.score(service_id), 1)
+            })
     
     # Top providers by earnings
     provider_earnings = {}
@@ -1396,13 +1390,12 @@ def analytics():
     for provider_id, earnings in sorted(provider_earnings.items(), key=lambda x: x[1], reverse=True)[:10]:
         provider = db.get_by_id('Users', provider_id)
         if provider:
-            provider_reviews = [r for r in reviews if r['provider_id'] == provider_id]
-            avg_rating = sum(r['rating'] for r in provider_reviews) / len(provider_reviews) if provider_reviews else 0
+            rating = current_app.ratings.for_provider(provider_id)
             top_providers.append({
                 'name': provider['name'],
                 'earnings': round(earnings, 2),
-                'rating': round(avg_rating, 1),
-                'review_count': len(provider_reviews)
+                'rating': round(rating['average'], 1),
+                'review_count': rating['count']
             })
     
     # Average booking value
@@ -1417,6 +1410,7 @@ def analytics():
         'revenue_stats': revenue_stats,
         'service_stats': service_stats,
         'service_popularity': service_popularity,
+        'popular_services': popular_services,
         'payment_method_dist': payment_method_dist,
         'top_providers': top_providers,
         'avg_booking_value': round(avg_booking_value, 2)
@@ -1437,6 +1431,88 @@ def analytics():
     
     return render_template('admin/analytics.html', analytics=analytics_data)
 
+@bp.route('/performance')
+@login_required
+@admin_required
+def performance():
+    """Per-endpoint latency percentiles and the slowest recent requests"""
+    summary = current_app.performance.summary()
+    return render_template('admin/performance.html', summary=summary,
+                           sample_rate=current_app.config.get('PERF_SAMPLE_RATE', 0.05),
+                           since=datetime.fromtimestamp(summary['since']).isoformat())
+
+@bp.route('/performance/reset', methods=['POST'])
+@login_required
+@admin_required
+def reset_performance():
+    """Clear this worker's request timings"""
+    current_app.performance.reset()
+    flash('Performance statistics have been reset.', 'success')
+    return redirect(url_for('admin.performance'))
+
+@bp.route('/profiles')
+@login_required
+@admin_required
+def profiles():
+    """Saved single-request cProfile captures"""
+    return render_template('admin/profiles.html',
+                           captures=profiler.list_captures(current_app.config['PROFILE_DIR']),
+                           flag=profiler.PROFILE_FLAG, header=profiler.PROFILE_HEADER)
+
+@bp.route('/profiles/<name>.<any(pstats, folded, json):ext>')
+@login_required
+@admin_required
+def download_profile(name, ext):
+    """Download one file of a capture"""
+    return send_from_directory(current_app.config['PROFILE_DIR'], f'{name}.{ext}', as_attachment=True)
+
+@bp.route('/memory')
+@login_required
+@admin_required
+def memory():
+    """Process memory, table/cache footprints and the last tracemalloc report"""
+    db = get_db()
+    tables = memory_profile.table_footprints(db)
+    return render_template('admin/memory.html',
+                           process=memory_profile.process_memory(),
+                           tables=tables,
+                           total_table_bytes=sum(t['memory_bytes'] for t in tables),
+                           caches=memory_profile.cache_footprints(db),
+                           tracing=current_app.memory_profiler.tracing,
+                           report=current_app.memory_profiler.report)
+
+@bp.route('/memory/<any(start, snapshot, stop):action>', methods=['POST'])
+@login_required
+@admin_required
+def memory_action(action):
+    """Start or stop tracemalloc, or take a snapshot"""
+    mem_profiler = current_app.memory_profiler
+    if action == 'start':
+        mem_profiler.start()
+        flash('Allocation tracing started. It slows this worker down until stopped.', 'warning')
+    elif action == 'stop':
+        mem_profiler.stop()
+        flash('Allocation tracing stopped.', 'success')
+    elif mem_profiler.take_snapshot() is None:
+        flash('Start allocation tracing before taking a snapshot.', 'error')
+    return redirect(url_for('admin.memory'))
+
+@bp.route('/storage-stats')
+@login_required
+@admin_required
+def storage_stats():
+    """Per-table DataManager counters and timings for this worker (JSON)"""
+    return jsonify(get_db().stats.snapshot())
+
+@bp.route('/storage-stats/reset', methods=['POST'])
+@login_required
+@admin_required
+def reset_storage_stats():
+    """Restart the storage stats view; the totals behind /metrics keep counting"""
+    get_db().stats.reset()
+    flash('Storage statistics have been reset.', 'success')
+    return redirect(url_for('admin.performance'))
+
 # ========== ACTIVITY LOG ==========
 
 @bp.route('/activity-log')
@@ -1451,9 +1527,7 @@ def activity_log():
     logs.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
     
     # Enrich with admin names
-    for log in logs:
-        admin = db.get_by_id('Users', log.get('admin_id'))
-        log['admin_name'] = admin.get('name') if admin else 'Unknown'
+    db.load_related(logs, {'admin_name': ('Users', 'admin_id', 'name', 'Unknown')})
     
     # Pagination (show 50 per page)
     page = request.args.get('page', 1, type=int)
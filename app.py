@@ -2,12 +2,34 @@ from flask import Flask, render_template, redirect, url_for, g, session
 from flask_wtf.csrf import CSRFProtect
 from flask_moment import Moment
 from data_manager import DataManager
+from ratings import RatingAggregates
+from platform_settings import PlatformSettings
+from platform_stats import PlatformStats
+from search import ServiceSearchIndex
+from catalog import ServiceCatalog
+from autocomplete import Autocomplete
+from popularity import ServicePopularity
+from fragments import ProviderSummaries
+from recommendations import TopRatedServices
+from collaborative import PersonalRecommendations, recommendations_cli
+from snapshots import snapshot_cli
+import identity_map
+import query_audit
+import performance
+import profiler
+import memory_profile
+import metrics
+import tracing
+import view_counter
 import auth
 import os
 
-def create_app():
+def create_app(config_object=None):
     app = Flask(__name__)
-    app.config.from_object("config.Config")
+    # `flask run --debug` and `python app.py` get the development settings
+    if config_object is None:
+        config_object = "config.DevelopmentConfig" if os.environ.get("FLASK_DEBUG") in ("1", "true") else "config.Config"
+    app.config.from_object(config_object)
     
     # Set secret key if not set in config
     if not app.secret_key:
@@ -21,6 +43,25 @@ def create_app():
     
     # Initialize DataManager
     app.db = DataManager(app.config["JSON_DATABASE_DIR"])
+    app.ratings = RatingAggregates(app.db)
+    app.platform_settings = PlatformSettings(app.db)
+    app.platform_stats = PlatformStats(app.db, ttl=app.config.get('PLATFORM_STATS_TTL'))
+    app.search_index = ServiceSearchIndex(app.db)
+    app.catalog = ServiceCatalog(app.db, app.ratings)
+    app.autocomplete = Autocomplete(app.db, app.catalog)
+    app.popularity = ServicePopularity(app.db, app.ratings)
+    app.provider_summaries = ProviderSummaries(app.db, app.ratings)
+    app.top_rated = TopRatedServices(app.db, app.catalog)
+    app.personal_recommendations = PersonalRecommendations(app.db)
+    app.cli.add_command(snapshot_cli)
+    app.cli.add_command(recommendations_cli)
+    identity_map.init_app(app)
+    query_audit.init_app(app)
+    performance.init_app(app)
+    memory_profile.init_app(app)
+    metrics.init_app(app)
+    tracing.init_app(app)
+    view_counter.init_app(app)
     
     # Register blueprints
     app.register_blueprint(auth.bp)
@@ -39,6 +80,9 @@ def create_app():
     
     import profile
     app.register_blueprint(profile.bp)
+
+    # Needs g.user, so it goes after auth's before_app_request
+    profiler.init_app(app)
     
     @app.route("/")
     def index():
@@ -50,27 +94,8 @@ def create_app():
             else:
                 return redirect(url_for("user_dashboard"))
         
-        # Calculate real platform statistics
-        all_users = app.db.get_all("Users")
-        all_reviews = app.db.get_all("Reviews")
-        all_bookings = app.db.get_all("Bookings")
-        
-        # Count active users (not banned/suspended)
-        active_users = len([u for u in all_users if u.get('status') == 'active'])
-        total_reviews = len(all_reviews)
-        
-        # Calculate average rating from all reviews
-        if total_reviews > 0:
-            avg_rating = sum([r.get('rating', 0) for r in all_reviews]) / total_reviews
-        else:
-            avg_rating = 0
-        
-        platform_stats = {
-            'total_users': active_users,
-            'total_reviews': total_reviews,
-            'average_rating': round(avg_rating, 1),
-            'total_bookings': len([b for b in all_bookings if b.get('booking_status') == 'completed'])
-        }
+        # Active users, reviews, average rating and completed bookings
+        platform_stats = app.platform_stats.summary()
         
         return render_template("index.html", platform_stats=platform_stats)
     
@@ -96,54 +121,30 @@ def create_app():
             "favorite_services": favorite_services
         }
 
-        # Get recommended services with provider and rating information
-        # Only show approved/active services from active providers with rating > 4.5
-        all_services = app.db.get_all("Services")
+        booked_services = app.db.get_by_ids("Services", {b["service_id"] for b in user_bookings})
+
+        # Recommended services: picks from the booking-history batch job first, then
+        # approved services of active providers rated above 4.5 from the top-rated lists
         recommended_services = []
-        
-        for service in all_services:
-            # Only show approved/active services
-            if service.get('status') not in ['active', 'approved']:
-                continue
-                
-            provider = app.db.get_by_id("Users", service.get("provider_id"))
-            
-            # Only show services from active providers
-            if not provider or provider.get('status') != 'active':
-                continue
-            
-            # Fetch bookings for this service to get related reviews
-            related_bookings = app.db.find_by_attribute("Bookings", "service_id", service.get("id"))
-            reviews = []
-            for booking in related_bookings:
-                review = app.db.get_by_id("Reviews", booking.get("id"))
-                if review:
-                    reviews.append(review)
-            
-            average_rating = sum([r.get("rating", 0) for r in reviews]) / len(reviews) if reviews else 0
-            
-            # Only show services with rating > 4.5
-            if average_rating <= 4.5:
-                continue
-            
-            category = app.db.get_by_id("Service_Categories", service.get("category_id")) if service.get("category_id") else None
-            recommended_services.append({
-                "id": service["id"],
-                "service_name": service["service_name"],
-                "category_name": category.get("category_name") if category else "Unknown Category",
-                "price": service.get("price", 0.00),
-                "provider_name": provider.get("name", "Unknown Provider") if provider else "Unknown Provider",
-                "rating": round(average_rating, 1)
-            })
-        
-        # Limit to top 4 recommended services
-        recommended_services = recommended_services[:4]
+        personal = app.personal_recommendations.for_user(user_id)
+        for service_id in app.top_rated.for_user(booked_services, personal=personal):
+            service = app.catalog.get(service_id)
+            if service:
+                recommended_services.append({
+                    "id": service["id"],
+                    "service_name": service["service_name"],
+                    "category_name": service["category_name"] if service["category_name"] != "Unknown" else "Unknown Category",
+                    "price": service.get("price", 0.00),
+                    "provider_name": service["provider_name"] if service["provider_name"] != "Unknown" else "Unknown Provider",
+                    "rating": round(service["avg_rating"], 1)
+                })
 
         # Prepare bookings data for display with debug printing
         bookings_display = []
+        booked_providers = app.db.get_by_ids("Users", {b["provider_id"] for b in user_bookings})
         for booking in user_bookings:
-            service = app.db.get_by_id("Services", booking["service_id"])
-            provider = app.db.get_by_id("Users", booking["provider_id"])
+            service = booked_services.get(booking["service_id"])
+            provider = booked_providers.get(booking["provider_id"])
             if service and provider:
                 print(f"Debug - Provider data for booking {booking['id']}: {provider}")
                 print(f"Debug - Provider name: {provider.get('name')}")
@@ -164,25 +165,25 @@ def create_app():
             return redirect(url_for("auth.login"))
 
         provider_id = g.user["id"]
-        all_services = app.db.get_all("Services")
-        my_services = [s for s in all_services if s["provider_id"] == provider_id]
+        my_services = app.catalog.for_provider(provider_id)
 
         all_bookings = app.db.get_all("Bookings")
         provider_bookings = [b for b in all_bookings if b["provider_id"] == provider_id]
 
-        all_reviews = app.db.get_all("Reviews")
-        my_reviews = [r for r in all_reviews if r["provider_id"] == provider_id]
+        my_reviews = app.db.find_by_attribute("Reviews", "provider_id", provider_id)
+        rating = app.ratings.for_provider(provider_id)
 
         # Calculate provider stats
         total_services = len(my_services)
         total_bookings = len(provider_bookings)
-        average_rating = sum([r["rating"] for r in my_reviews]) / len(my_reviews) if my_reviews else 0
+        average_rating = rating["average"]
 
         # Calculate total_earnings using service price
+        booked_services = app.db.get_by_ids("Services", {b["service_id"] for b in provider_bookings})
         total_earnings = 0
         for b in provider_bookings:
             if b["booking_status"] == "completed":
-                service = app.db.get_by_id("Services", b["service_id"])
+                service = booked_services.get(b["service_id"])
                 if service:
                     total_earnings += service["price"]
 
@@ -194,8 +195,8 @@ def create_app():
         completion_rate = len([b for b in provider_bookings if b["booking_status"] == "completed"]) / total_bookings * 100 if total_bookings else 0
         
         # Calculate real customer satisfaction (% of 4+ star reviews)
-        high_rated_reviews = len([r for r in my_reviews if r.get("rating", 0) >= 4])
-        satisfaction_rate = (high_rated_reviews / len(my_reviews) * 100) if my_reviews else 0
+        high_rated_reviews = rating["histogram"][4] + rating["histogram"][5]
+        satisfaction_rate = (high_rated_reviews / rating["count"] * 100) if rating["count"] else 0
 
         provider_stats = {
             "total_services": total_services,
@@ -209,9 +210,10 @@ def create_app():
 
         # Prepare booking requests data for display
         booking_requests = []
+        customers = app.db.get_by_ids("Users", {b["user_id"] for b in provider_bookings} | {r["user_id"] for r in my_reviews})
         for booking in provider_bookings:
-            user = app.db.get_by_id("Users", booking["user_id"])
-            service = app.db.get_by_id("Services", booking["service_id"])
+            user = customers.get(booking["user_id"])
+            service = booked_services.get(booking["service_id"])
             if user and service:
                 booking_requests.append({
                     "id": booking["id"],
@@ -223,22 +225,23 @@ def create_app():
                 })
         
         # Prepare my services data for display
+        view_stats = app.view_counter.stats([s["id"] for s in my_services])
         my_services_display = []
         for service in my_services:
-            category = app.db.get_by_id("Service_Categories", service.get("category_id"))
             my_services_display.append({
                 "id": service["id"],
                 "service_name": service["service_name"],
-                "category_name": category.get("category_name") if category else "Unknown Category",
+                "category_name": service["category_name"] if service["category_name"] != "Unknown" else "Unknown Category",
                 "status": service["status"],
-                "views": service.get("views", 0),
+                "views": view_stats[service["id"]]["total"],
+                "views_this_week": view_stats[service["id"]]["recent"],
                 "price": service["price"]
             })
 
         # Prepare recent reviews data for display
         recent_reviews = []
         for review in my_reviews:
-            user = app.db.get_by_id("Users", review["user_id"])
+            user = customers.get(review["user_id"])
             if user:
                 recent_reviews.append({
                     "user_name": user["name"],
@@ -253,8 +256,11 @@ def create_app():
     def admin_dashboard():
         return render_template("admin_dashboard.html")
     
+    # After every route is registered, so each view gets a span
+    tracing.trace_views(app)
+    
     return app
 
 if __name__ == "__main__":
-    app = create_app()
+    app = create_app("config.DevelopmentConfig")
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,225 @@
+"""Search-box suggestions for service names, category names and locations.
+
+Every suggestion is stored under each of its word starts ("Deep Home
+Cleaning" under "deep home cleaning", "home cleaning" and "cleaning") in
+one sorted array, so a typed prefix is a bisect range. Only services the
+catalog shows to everyone (approved, from an active provider) are
+suggested, and a provider's services are re-indexed when their status
+changes. Suggestions are ranked by bookings: a service name or location
+counts the bookings of all such services that carry it, a category those
+of its services. The best few for short prefixes, whose ranges are long,
+are memoised and dropped only for the prefixes of a suggestion whose
+count changed.
+"""
+import bisect
+import heapq
+
+from catalog import is_public
+from data_manager import TableCache
+from search import tokenize
+
+# Prefixes up to this many characters have their best suggestions memoised
+MEMO_PREFIX_LENGTH = 3
+MAX_SUGGESTIONS = 10
+
+def _keys(label):
+    words = tokenize(label)
+    return {' '.join(words[start:]) for start in range(len(words))}
+
+class Autocomplete(TableCache):
+    tables = ('Services', 'Users', 'Service_Categories', 'Bookings')
+
+    def __init__(self, db, catalog):
+        super().__init__(db)
+        self.catalog = catalog
+        self._keys = []
+        self._weights = {}
+        self._refs = {}
+        self._service_entries = {}
+        self._service_category = {}
+        self._categories = {}
+        self._category_bookings = {}
+        self._bookings = {}
+        self._booking_services = {}
+        self._memo = {}
+
+    def suggest(self, prefix, limit=MAX_SUGGESTIONS):
+        """[(kind, label, value, bookings)] for the suggestions matching prefix, most booked first.
+
+        kind is 'service', 'category' or 'location'; value is the label,
+        or the category id for categories.
+        """
+        query = ' '.join(tokenize(prefix))
+        if not query:
+            return []
+        if prefix[-1:].isspace():
+            query += ' '
+        limit = min(limit, MAX_SUGGESTIONS)
+        self.ensure_fresh()
+        with self.lock:
+            if len(query) <= MEMO_PREFIX_LENGTH:
+                best = self._memo.get(query)
+                if best is None:
+                    best = self._memo[query] = self._best(query, MAX_SUGGESTIONS)
+            else:
+                best = self._best(query, limit)
+            return [entry + (self._weight(entry),) for entry in best[:limit]]
+
+    def _best(self, query, limit):
+        index = bisect.bisect_left(self._keys, (query,))
+        entries = set()
+        while index < len(self._keys) and self._keys[index][0].startswith(query):
+            entries.add(self._keys[index][1])
+            index += 1
+        return heapq.nsmallest(limit, entries, key=self._rank)
+
+    def _rank(self, entry):
+        return -self._weight(entry), entry[1]
+
+    def _weight(self, entry):
+        if entry[0] == 'category':
+            return self._category_bookings.get(entry[2], 0)
+        return self._weights.get(entry, 0)
+
+    def _rebuild(self):
+        self._keys = []
+        self._weights = {}
+        self._refs = {}
+        self._service_entries = {}
+        self._service_category = {}
+        self._categories = {}
+        self._category_bookings = {}
+        self._bookings = {}
+        self._booking_services = {}
+        self._memo = {}
+        for booking in self.db.get_all('Bookings'):
+            self._booking_services[booking['id']] = booking.get('service_id')
+            self._bookings[booking.get('service_id')] = self._bookings.get(booking.get('service_id'), 0) + 1
+        for category in self.db.get_all('Service_Categories'):
+            self._put_category(category)
+        for listing in self.catalog.visible_to(None):
+            self._put_service(listing)
+        self._keys.sort()
+
+    def _apply(self, table_name, action, item, previous):
+        if table_name == 'Services':
+            self._drop_service(item['id'])
+            listing = self.catalog.get(item['id'])
+            if listing is not None:
+                self._put_service(listing, keep_sorted=True)
+        elif table_name == 'Users':
+            if action == 'update' and previous.get('status') == item.get('status'):
+                return True
+            # The catalog's listener has already joined the provider's new status
+            for listing in self.catalog.for_provider(item['id']):
+                self._drop_service(listing['id'])
+                self._put_service(listing, keep_sorted=True)
+        elif table_name == 'Service_Categories':
+            self._drop_category(item['id'])
+            if action != 'delete':
+                self._put_category(item, keep_sorted=True)
+        elif table_name == 'Bookings':
+            old_service = self._booking_services.pop(item['id'], None)
+            if old_service is not None:
+                self._add_bookings(old_service, -1)
+            if action != 'delete':
+                self._booking_services[item['id']] = item.get('service_id')
+                self._add_bookings(item.get('service_id'), 1)
+        return True
+
+    def _add_bookings(self, service_id, delta):
+        self._bookings[service_id] = self._bookings.get(service_id, 0) + delta
+        for entry in self._service_entries.get(service_id, ()):
+            self._reweigh(entry, delta)
+        if service_id in self._service_category:
+            self._reweigh_category(self._service_category[service_id], delta)
+
+    def _put_service(self, service, keep_sorted=False):
+        """Index a catalog listing, if it is public"""
+        if not is_public(service):
+            return
+        service_id = service['id']
+        entries = []
+        for kind, label in (('service', service.get('service_name')), ('location', service.get('location'))):
+            label = (label or '').strip()
+            if _keys(label):
+                entries.append((kind, label, label))
+        self._service_entries[service_id] = entries
+        bookings = self._bookings.get(service_id, 0)
+        for entry in entries:
+            self._refs[entry] = self._refs.get(entry, 0) + 1
+            if self._refs[entry] == 1:
+                self._add_keys(entry, keep_sorted)
+            self._reweigh(entry, bookings)
+        self._service_category[service_id] = service.get('category_id')
+        self._reweigh_category(service.get('category_id'), bookings)
+
+    def _drop_service(self, service_id):
+        bookings = self._bookings.get(service_id, 0)
+        for entry in self._service_entries.pop(service_id, ()):
+            self._reweigh(entry, -bookings)
+            self._refs[entry] -= 1
+            if not self._refs[entry]:
+                del self._refs[entry]
+                self._weights.pop(entry, None)
+                self._remove_keys(entry)
+        if service_id in self._service_category:
+            self._reweigh_category(self._service_category.pop(service_id), -bookings)
+
+    def _put_category(self, category, keep_sorted=False):
+        label = (category.get('category_name') or '').strip()
+        if category.get('is_active', True) and _keys(label):
+            entry = self._categories[category['id']] = ('category', label, category['id'])
+            self._add_keys(entry, keep_sorted)
+
+    def _drop_category(self, category_id):
+        entry = self._categories.pop(category_id, None)
+        if entry is not None:
+            self._remove_keys(entry)
+
+    def _reweigh(self, entry, delta):
+        if not delta:
+            return
+        self._weights[entry] = self._weights.get(entry, 0) + delta
+        self._forget(entry, grew=delta > 0)
+
+    def _reweigh_category(self, category_id, delta):
+        if not delta:
+            return
+        self._category_bookings[category_id] = self._category_bookings.get(category_id, 0) + delta
+        if category_id in self._categories:
+            self._forget(self._categories[category_id], grew=delta > 0)
+
+    def _add_keys(self, entry, keep_sorted):
+        for key in _keys(entry[1]):
+            if keep_sorted:
+                bisect.insort(self._keys, (key, entry))
+            else:
+                self._keys.append((key, entry))
+        self._forget(entry, grew=True)
+
+    def _remove_keys(self, entry):
+        for key in _keys(entry[1]):
+            index = bisect.bisect_left(self._keys, (key, entry))
+            if index < len(self._keys) and self._keys[index] == (key, entry):
+                self._keys.pop(index)
+        self._forget(entry)
+
+    def _forget(self, entry, grew=False):
+        """Update memoised results for the prefixes entry is listed under.
+
+        An entry that is new or gained bookings can only move up, so it is
+        ranked into each memoised list; otherwise those lists are dropped.
+        """
+        if not self._memo:
+            return
+        for key in _keys(entry[1]):
+            for length in range(1, MEMO_PREFIX_LENGTH + 1):
+                prefix = key[:length]
+                best = self._memo.get(prefix)
+                if best is None:
+                    continue
+                if grew:
+                    self._memo[prefix] = heapq.nsmallest(MAX_SUGGESTIONS, set(best) | {entry}, key=self._rank)
+                else:
+                    del self._memo[prefix]
@@ -15,12 +15,13 @@ def generate_otp():
     return "".join(random.choices(string.digits, k=6))
 
 def calculate_platform_fee(amount):
-    """Calculate platform fee (10% of service price)"""
-    db = get_db()
-    settings = db.get_all('Platform_Settings')
-    fee_setting = next((s for s in settings if s['setting_key'] == 'platform_fee_percentage'), None)
-    fee_percentage = float(fee_setting['setting_value']) / 100 if fee_setting else 0.10
-    return round(amount * fee_percentage, 2)
+    """Calculate platform fee (platform_fee_percentage of service price, 10% by default)"""
+    try:
+        # Settings saved without a number type keep their value as a string
+        fee_percentage = float(current_app.platform_settings.get('platform_fee_percentage', 10))
+    except (ValueError, TypeError):
+        fee_percentage = 10
+    return round(amount * fee_percentage / 100, 2)
 
 @bp.route("/")
 @login_required
@@ -34,14 +35,11 @@ def list_bookings():
         else:
             bookings = db.find_by_attribute("Bookings", "user_id", g.user["id"])
     
-    for booking in bookings:
-        service = db.get_by_id("Services", booking.get("service_id"))
-        user = db.get_by_id("Users", booking.get("user_id"))
-        provider = db.get_by_id("Users", booking.get("provider_id"))
-        
-        booking["service"] = service
-        booking["user"] = user
-        booking["provider"] = provider
+    db.load_related(bookings, {
+        "service": ("Services", "service_id"),
+        "user": ("Users", "user_id"),
+        "provider": ("Users", "provider_id")
+    })
     
     return render_template("bookings/list.html", bookings=bookings)
 
@@ -75,28 +73,15 @@ def book_service(service_id):
         flash("This service is not available at the moment.", "error")
         return redirect(url_for("services.browse"))
     
-    reviews = db.find_by_attribute("Reviews", "provider_id", provider["id"])
-    if reviews:
-        avg_rating = sum(r["rating"] for r in reviews) / len(reviews)
-        review_count = len(reviews)
-    else:
-        avg_rating = 0
-        review_count = 0
+    rating = current_app.ratings.for_provider(provider["id"])
+    avg_rating = rating["average"]
+    review_count = rating["count"]
     form = BookingForm()
     
     # Populate payment methods dynamically from Platform_Settings
-    settings = db.get_all('Platform_Settings')
-    payment_setting = next((s for s in settings if s['setting_key'] == 'payment_methods'), None)
-    if payment_setting:
-        methods = payment_setting['setting_value'].split(',')
-        # Clean up display: aggressively remove all quotes, brackets, and extra spaces
-        cleaned_methods = []
-        for m in methods:
-            # Strip whitespace, then remove all quotes and brackets
-            clean = m.strip().strip('"').strip("'").strip('[]').strip('"').strip("'").strip()
-            if clean:  # Only add non-empty methods
-                cleaned_methods.append((clean.lower().replace(' ', '_'), clean))
-        form.payment_method.choices = cleaned_methods
+    payment_methods = current_app.platform_settings.payment_method_choices()
+    if payment_methods:
+        form.payment_method.choices = payment_methods
     
     # Create a dummy booking for GET request to avoid undefined error
     booking = {
@@ -168,7 +153,8 @@ def payment(booking_id):
     
     service = db.get_by_id("Services", booking.get("service_id"))
     provider = db.get_by_id("Users", booking.get("provider_id"))
-    payment = db.find_by_attribute("Payments", "booking_id", booking_id)[0] if db.find_by_attribute("Payments", "booking_id", booking_id) else None
+    payments = db.find_by_attribute("Payments", "booking_id", booking_id)
+    payment = payments[0] if payments else None
     form = ConfirmForm()
     
     if provider:
@@ -193,7 +179,8 @@ def confirm(booking_id):
     
     service = db.get_by_id("Services", booking.get("service_id"))
     provider = db.get_by_id("Users", booking.get("provider_id"))
-    payment = db.find_by_attribute("Payments", "booking_id", booking_id)[0] if db.find_by_attribute("Payments", "booking_id", booking_id) else None
+    payments = db.find_by_attribute("Payments", "booking_id", booking_id)
+    payment = payments[0] if payments else None
     
     if not payment:
         flash("Payment information not found.", "error")
@@ -244,9 +231,7 @@ def detail(booking_id):
     payment = payment[0] if payment else None
     
     messages = db.find_by_attribute("Chat_Messages", "booking_id", booking_id)
-    for message in messages:
-        sender = db.get_by_id("Users", message.get("sender_id"))
-        message["sender_name"] = sender.get("name") if sender else "Unknown"
+    db.load_related(messages, {"sender_name": ("Users", "sender_id", "name", "Unknown")})
     
     review = db.find_by_attribute("Reviews", "booking_id", booking_id)
     review = review[0] if review else None
@@ -449,6 +434,7 @@ def review_booking(booking_id):
                 "booking_id": booking_id,
                 "user_id": g.user["id"],
                 "provider_id": booking["provider_id"],
+                "service_id": booking.get("service_id"),
                 "rating": form.rating.data,
                 "comment": form.comment.data,
                 "created_at": datetime.now().isoformat()
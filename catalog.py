@@ -0,0 +1,364 @@
+import bisect
+
+from data_manager import TableCache
+from search import tokenize
+
+# Price bands offered as a browse facet: lower bound inclusive, upper exclusive
+PRICE_BANDS = ((0, 25), (25, 50), (50, 100), (100, 250), (250, 500), (500, None))
+_BAND_EDGES = [low for low, high in PRICE_BANDS]
+
+FACETS = ('category', 'location', 'price_band')
+
+def _price(listing):
+    try:
+        return float(listing.get('price') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _price_band(price):
+    return max(bisect.bisect_right(_BAND_EDGES, price) - 1, 0)
+
+def is_public(listing):
+    """Shown to everyone: an approved service of an active provider"""
+    return listing['provider_status'] == 'active' and listing.get('status') in ('active', 'approved')
+
+def _intersect(sets):
+    """Intersection of id sets, smallest first; None if there are no sets"""
+    if not sets:
+        return None
+    sets = sorted(sets, key=len)
+    result = set(sets[0])
+    for other in sets[1:]:
+        result &= other
+        if not result:
+            break
+    return result
+
+class ServiceCatalog(TableCache):
+    """Services joined with their provider, category and rating, ready to list.
+
+    Each listing is the service row plus provider_name, provider_email,
+    provider_status, category_name, avg_rating and review_count. Writes to
+    any of the source tables patch only the listings they touch, so browse
+    and the dashboards filter and sort one prepared collection instead of
+    joining four tables per request. Listings handed out are shared: copy
+    one before changing it.
+
+    ``select`` narrows listings with secondary indexes: id sets per
+    category, per location word and per price band, and a list of
+    (price, id) kept sorted with bisect, so a price range is a slice that
+    is already in price order. ``select_faceted`` also counts, for each
+    facet, how many results every value would give with the other filters
+    kept; counts over all public listings are maintained as services change.
+    """
+    tables = ('Services', 'Users', 'Service_Categories', 'Reviews')
+
+    def __init__(self, db, ratings):
+        super().__init__(db)
+        self.ratings = ratings
+        self._listings = {}
+        self._by_provider = {}
+        self._providers = {}
+        self._categories = {}
+        self._by_category = {}
+        self._by_location = {}
+        self._location_terms = []
+        self._prices = []
+        self._by_band = {}
+        self._location_words = {}
+        self._public = set()
+        self._public_counts = {facet: {} for facet in FACETS}
+
+    def select(self, user_id=None, ids=None, category_id=None, location=None,
+               min_price=None, max_price=None, price_band=None, price_order=None):
+        """Listings visible to user_id that match every given filter.
+
+        ids limits the result to those services (e.g. search matches).
+        location matches services whose location has a word starting with
+        each word of it; price_band is an index into PRICE_BANDS. With
+        price_order 'asc' or 'desc' the result comes back sorted by price
+        (ties by id), otherwise in no particular order.
+        """
+        self.ensure_fresh()
+        with self.lock:
+            filters = self._filter_sets(ids, category_id, location, price_band)
+            return [self._listings[service_id] for service_id in
+                    self._matching(user_id, filters, min_price, max_price, price_order)]
+
+    def select_faceted(self, user_id=None, ids=None, category_id=None, location=None,
+                       min_price=None, max_price=None, price_band=None, price_order=None):
+        """(listings, counts) for the same filters as ``select``.
+
+        counts maps each facet ('category', 'location', 'price_band') to
+        {value: number of results}, computed with that facet's own filter
+        left out, so it says what picking another value would give.
+        """
+        self.ensure_fresh()
+        with self.lock:
+            filters = self._filter_sets(ids, category_id, location, price_band)
+            matching = self._matching(user_id, filters, min_price, max_price, price_order)
+            counts = {}
+            for facet in FACETS:
+                others = [(name, ids) for name, ids in filters if name != facet]
+                if not others and min_price is None and max_price is None:
+                    counts[facet] = self._count_visible(facet, user_id)
+                elif len(others) == len(filters):
+                    counts[facet] = self._count(facet, matching)
+                else:
+                    counts[facet] = self._count(facet, self._matching(user_id, others, min_price, max_price))
+            return [self._listings[service_id] for service_id in matching], counts
+
+    def _filter_sets(self, ids, category_id, location, price_band):
+        """(facet, id set) pairs a result must be in, one per filter or location word"""
+        filters = []
+        if ids is not None:
+            filters.append(('ids', ids if isinstance(ids, (set, frozenset)) else set(ids)))
+        if category_id is not None:
+            filters.append(('category', self._by_category.get(category_id, set())))
+        if location:
+            words = tokenize(location)
+            filters.extend(('location', self._location_matches(word)) for word in words)
+            if not words:
+                filters.append(('location', set()))
+        if price_band is not None:
+            filters.append(('price_band', self._by_band.get(price_band, set())))
+        return filters
+
+    def _matching(self, user_id, filters, min_price=None, max_price=None, price_order=None):
+        """Ids of the visible listings in every filter set and the price range"""
+        sets = [ids for name, ids in filters]
+        if min_price is None and max_price is None and price_order is None:
+            candidates = _intersect(sets)
+            if candidates is None:
+                matches = list(self._listings)
+            else:
+                matches = [service_id for service_id in candidates if service_id in self._listings]
+        else:
+            start = 0 if min_price is None else bisect.bisect_left(self._prices, (min_price, float('-inf')))
+            end = len(self._prices) if max_price is None else bisect.bisect_right(self._prices, (max_price, float('inf')))
+            if sets and min(len(ids) for ids in sets) < end - start:
+                # Fewer candidates than prices in range: check and sort the candidates instead
+                low = float('-inf') if min_price is None else min_price
+                high = float('inf') if max_price is None else max_price
+                keyed = sorted((_price(self._listings[service_id]), service_id) for service_id in _intersect(sets)
+                               if service_id in self._listings)
+                in_range = [service_id for price, service_id in keyed if low <= price <= high]
+            else:
+                # A narrow range: walk the slice and test each id against the filters
+                in_range = [service_id for price, service_id in self._prices[start:end]]
+                for ids in sorted(sets, key=len):
+                    in_range = [service_id for service_id in in_range if service_id in ids]
+            if price_order == 'desc':
+                in_range.reverse()
+            matches = in_range
+        own = self._own_hidden(user_id)
+        if own:
+            return [service_id for service_id in matches if service_id in self._public or service_id in own]
+        return [service_id for service_id in matches if service_id in self._public]
+
+    def _own_hidden(self, user_id):
+        """Ids of user_id's listings that only they can see"""
+        if user_id is None:
+            return set()
+        return {service_id for service_id in self._by_provider.get(user_id, ())
+                if service_id not in self._public and self._visible(self._listings[service_id], user_id)}
+
+    def _count(self, facet, service_ids):
+        postings = {'category': self._by_category, 'price_band': self._by_band}.get(facet)
+        if postings is not None and len(service_ids) > 64 * len(postings):
+            # Many results over few values: intersect with each value's id set instead
+            service_ids = set(service_ids)
+            counts = {value: len(service_ids & ids) for value, ids in postings.items()}
+            return {value: count for value, count in counts.items() if count}
+        counts = {}
+        for service_id in service_ids:
+            for value in self._facet_values(facet, self._listings[service_id]):
+                counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    def _count_visible(self, facet, user_id):
+        """Counts over everything user_id can see: the kept public counts plus their own other listings"""
+        counts = dict(self._public_counts[facet])
+        for value, count in self._count(facet, self._own_hidden(user_id)).items():
+            counts[value] = counts.get(value, 0) + count
+        return counts
+
+    def _facet_values(self, facet, listing):
+        if facet == 'category':
+            return (listing.get('category_id'),)
+        if facet == 'location':
+            return self._location_words[listing['id']]
+        return (_price_band(_price(listing)),)
+
+    def _count_public(self, listing, sign):
+        """Add (1) or remove (-1) a listing from the public ids and kept facet counts if it is public"""
+        if not is_public(listing):
+            return
+        if sign > 0:
+            self._public.add(listing['id'])
+        else:
+            self._public.discard(listing['id'])
+        for facet in FACETS:
+            counts = self._public_counts[facet]
+            for value in self._facet_values(facet, listing):
+                counts[value] = counts.get(value, 0) + sign
+                if not counts[value]:
+                    del counts[value]
+
+    def visible_to(self, user_id=None):
+        """Listings shown in browse: approved services of active providers, plus the viewer's own"""
+        self.ensure_fresh()
+        with self.lock:
+            return [listing for listing in self._listings.values() if self._visible(listing, user_id)]
+
+    def for_provider(self, provider_id):
+        self.ensure_fresh()
+        with self.lock:
+            return [self._listings[service_id] for service_id in sorted(self._by_provider.get(provider_id, ()))]
+
+    def get(self, service_id):
+        self.ensure_fresh()
+        with self.lock:
+            listing = self._listings.get(service_id)
+            return dict(listing) if listing else None
+
+    def active_categories(self):
+        self.ensure_fresh()
+        with self.lock:
+            return [dict(c) for c in self._categories.values() if c.get('is_active', True)]
+
+    @staticmethod
+    def _visible(listing, user_id):
+        return is_public(listing) or (
+            listing['provider_status'] == 'active' and user_id is not None and listing.get('provider_id') == user_id)
+
+    def _location_matches(self, word):
+        """Ids of services with a location word starting with word"""
+        start = bisect.bisect_left(self._location_terms, word)
+        end = start
+        while end < len(self._location_terms) and self._location_terms[end].startswith(word):
+            end += 1
+        if end - start == 1:
+            return self._by_location[self._location_terms[start]]
+        matches = set()
+        for term in self._location_terms[start:end]:
+            matches |= self._by_location[term]
+        return matches
+
+    def _rebuild(self):
+        services = self.db.get_all('Services')
+        self._providers = {u['id']: self._provider_fields(u) for u in self.db.get_all('Users')}
+        self._categories = {c['id']: c for c in self.db.get_all('Service_Categories')}
+        ratings = self.ratings.all_services()
+        self._listings = {}
+        self._by_provider = {}
+        self._by_category = {}
+        self._by_location = {}
+        self._location_terms = []
+        self._prices = []
+        self._by_band = {}
+        self._location_words = {}
+        self._public = set()
+        self._public_counts = {facet: {} for facet in FACETS}
+        for service in services:
+            self._put(service, ratings.get(service['id']), keep_sorted=False)
+        self._location_terms = sorted(self._by_location)
+        self._prices.sort()
+
+    def _apply(self, table_name, action, item, previous):
+        if table_name == 'Services':
+            self._drop(item['id'])
+            if action != 'delete':
+                self._put(item, self.ratings.for_service(item['id']))
+        elif table_name == 'Users':
+            if action == 'delete':
+                self._providers.pop(item['id'], None)
+            else:
+                self._providers[item['id']] = self._provider_fields(item)
+            for service_id in self._by_provider.get(item['id'], ()):
+                listing = self._listings[service_id]
+                self._count_public(listing, -1)
+                listing.update(self._join_provider(item['id']))
+                self._count_public(listing, 1)
+        elif table_name == 'Service_Categories':
+            if action == 'delete':
+                self._categories.pop(item['id'], None)
+            else:
+                self._categories[item['id']] = item
+            name = self._category_name(item['id'])
+            for service_id in self._by_category.get(item['id'], ()):
+                self._listings[service_id]['category_name'] = name
+        elif table_name == 'Reviews':
+            service_ids = {row.get('service_id') for row in (item, previous) if row}
+            if None in service_ids:
+                # Older reviews only reach their service through the booking
+                return False
+            for service_id in service_ids:
+                if service_id in self._listings:
+                    self._listings[service_id].update(self._join_rating(self.ratings.for_service(service_id)))
+        return True
+
+    def _put(self, service, rating, keep_sorted=True):
+        service_id = service['id']
+        listing = dict(service)
+        listing.update(self._join_provider(service.get('provider_id')))
+        listing['category_name'] = self._category_name(service.get('category_id'))
+        listing.update(self._join_rating(rating))
+        self._listings[service_id] = listing
+        self._by_provider.setdefault(service.get('provider_id'), set()).add(service_id)
+        self._by_category.setdefault(service.get('category_id'), set()).add(service_id)
+        self._location_words[service_id] = frozenset(tokenize(service.get('location')))
+        for term in self._location_words[service_id]:
+            if term not in self._by_location:
+                self._by_location[term] = set()
+                if keep_sorted:
+                    bisect.insort(self._location_terms, term)
+            self._by_location[term].add(service_id)
+        if keep_sorted:
+            bisect.insort(self._prices, (_price(listing), service_id))
+        else:
+            self._prices.append((_price(listing), service_id))
+        self._by_band.setdefault(_price_band(_price(listing)), set()).add(service_id)
+        self._count_public(listing, 1)
+
+    def _drop(self, service_id):
+        listing = self._listings.pop(service_id, None)
+        if listing is None:
+            return
+        self._by_provider.get(listing.get('provider_id'), set()).discard(service_id)
+        self._by_category.get(listing.get('category_id'), set()).discard(service_id)
+        self._by_band.get(_price_band(_price(listing)), set()).discard(service_id)
+        self._count_public(listing, -1)
+        for term in self._location_words.pop(service_id, ()):
+            ids = self._by_location.get(term)
+            if ids is None:
+                continue
+            ids.discard(service_id)
+            if not ids:
+                del self._by_location[term]
+                index = bisect.bisect_left(self._location_terms, term)
+                if index < len(self._location_terms) and self._location_terms[index] == term:
+                    self._location_terms.pop(index)
+        index = bisect.bisect_left(self._prices, (_price(listing), service_id))
+        if index < len(self._prices) and self._prices[index] == (_price(listing), service_id):
+            self._prices.pop(index)
+
+    @staticmethod
+    def _provider_fields(user):
+        return {'name': user.get('name'), 'email': user.get('email'), 'status': user.get('status')}
+
+    def _join_provider(self, provider_id):
+        provider = self._providers.get(provider_id, {})
+        return {
+            'provider_name': provider.get('name') or 'Unknown',
+            'provider_email': provider.get('email') or 'Unknown',
+            'provider_status': provider.get('status')
+        }
+
+    def _category_name(self, category_id):
+        category = self._categories.get(category_id)
+        return category.get('category_name', 'Unknown') if category else 'Unknown'
+
+    @staticmethod
+    def _join_rating(rating):
+        return {'avg_rating': rating['average'] if rating else 0, 'review_count': rating['count'] if rating else 0}
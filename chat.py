@@ -1,13 +1,39 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, g, current_app, jsonify
 from auth import login_required
+from conditional import VersionedEtags, etag_response, not_modified
 from datetime import datetime
 import json
+import time
 
 bp = Blueprint('chat', __name__, url_prefix='/chat')
 
+# The chat page polls get_messages every 5 seconds; a window that hasn't
+# polled for this long is no longer counted as active
+POLLER_WINDOW = 15
+
+# Last get_messages poll per (user_id, booking_id) in this worker
+_last_polls = {}
+
 def get_db():
     return current_app.db
 
+def active_pollers():
+    """Chat windows that polled this worker within POLLER_WINDOW seconds"""
+    cutoff = time.time() - POLLER_WINDOW
+    for key, polled_at in list(_last_polls.items()):
+        if polled_at < cutoff:
+            _last_polls.pop(key, None)
+    return len(_last_polls)
+
+@bp.record_once
+def register_metrics(state):
+    state.app.metrics.register_gauge('chat_active_pollers', 'Open chat windows polling for new messages', active_pollers)
+
+@bp.record_once
+def create_poll_etags(state):
+    # get_messages output depends on the booking, its messages and the senders' names
+    state.app.chat_poll_etags = VersionedEtags(state.app.db, ('Bookings', 'Chat_Messages', 'Users'))
+
 @bp.route('/booking/<int:booking_id>')
 @login_required
 def booking_chat(booking_id):
@@ -31,9 +57,8 @@ def booking_chat(booking_id):
     messages.sort(key=lambda x: x.get('sent_at', ''))
     
     # Enrich messages with sender information
+    db.load_related(messages, {'sender_name': ('Users', 'sender_id', 'name', 'Unknown')})
     for message in messages:
-        sender = db.get_by_id('Users', message.get('sender_id'))
-        message['sender_name'] = sender.get('name') if sender else 'Unknown'
         message['is_own'] = message['sender_id'] == g.user['id']
     
     # Get other participant info
@@ -115,8 +140,16 @@ def send_message(booking_id):
 @bp.route('/get_messages/<int:booking_id>')
 @login_required
 def get_messages(booking_id):
-    """Get chat messages for a booking (AJAX endpoint)"""
+    """Get chat messages for a booking (AJAX endpoint, answers 304 when nothing changed)"""
     db = get_db()
+    poll_etags = current_app.chat_poll_etags
+    poll_key = (g.user['id'], booking_id)
+    versions = poll_etags.versions()
+    etag = poll_etags.unchanged(poll_key, versions)
+    if etag:
+        _last_polls[poll_key] = time.time()
+        return not_modified(etag)
+    
     booking = db.get_by_id('Bookings', booking_id)
     
     if not booking:
@@ -126,6 +159,8 @@ def get_messages(booking_id):
     if g.user['id'] not in [booking['user_id'], booking['provider_id']]:
         return jsonify({'success': False, 'error': 'Access denied'})
     
+    _last_polls[poll_key] = time.time()
+    
     # Get messages
     messages = db.find_by_attribute('Chat_Messages', 'booking_id', booking_id)
     
@@ -133,12 +168,13 @@ def get_messages(booking_id):
     messages.sort(key=lambda x: x.get('sent_at', ''))
     
     # Enrich messages with sender information
+    db.load_related(messages, {'sender_name': ('Users', 'sender_id', 'name', 'Unknown')})
     for message in messages:
-        sender = db.get_by_id('Users', message.get('sender_id'))
-        message['sender_name'] = sender.get('name') if sender else 'Unknown'
         message['is_own'] = message['sender_id'] == g.user['id']
     
-    return jsonify({"success": True, "messages": messages})
+    response = etag_response(jsonify({"success": True, "messages": messages}))
+    poll_etags.remember(poll_key, versions, response)
+    return response
 
 @bp.route("/mark_read/<int:booking_id>", methods=["POST"])
 @login_required
@@ -177,10 +213,19 @@ def conversations():
     all_bookings = db.get_all('Bookings')
     user_bookings = [b for b in all_bookings if b['user_id'] == g.user['id'] or b['provider_id'] == g.user['id']]
     
+    # Load messages, participants and services for all bookings at once
+    booking_ids = {b['id'] for b in user_bookings}
+    messages_by_booking = {}
+    for message in db.get_all('Chat_Messages'):
+        if message.get('booking_id') in booking_ids:
+            messages_by_booking.setdefault(message['booking_id'], []).append(message)
+    users = db.get_by_ids('Users', {b['user_id'] for b in user_bookings} | {b['provider_id'] for b in user_bookings})
+    services = db.get_by_ids('Services', {b.get('service_id') for b in user_bookings})
+    
     conversations = []
     for booking in user_bookings:
         # Get last message
-        messages = db.find_by_attribute('Chat_Messages', 'booking_id', booking['id'])
+        messages = messages_by_booking.get(booking['id'], [])
         if messages:
             messages.sort(key=lambda x: x.get('sent_at', ''), reverse=True)
             last_message = messages[0]
@@ -193,12 +238,12 @@ def conversations():
         
         # Get other participant
         if g.user['id'] == booking['user_id']:
-            other_user = db.get_by_id('Users', booking['provider_id'])
+            other_user = users.get(booking['provider_id'])
         else:
-            other_user = db.get_by_id('Users', booking['user_id'])
+            other_user = users.get(booking['user_id'])
         
         # Get service info
-        service = db.get_by_id('Services', booking.get('service_id'))
+        service = services.get(booking.get('service_id'))
         
         conversations.append({
             'booking': booking,
@@ -0,0 +1,167 @@
+"""Personal service recommendations from booking history.
+
+A batch job (``flask recommendations build``) builds a sparse user x
+service matrix from Bookings and Reviews: a booking counts BOOKING_WEIGHT
+and a review moves that up or down by how far its rating is from three
+stars, so a service the user panned drops out. Services are compared by
+the cosine of their columns and each keeps its NEIGHBOURS most similar
+services. A user's candidates are scored by summing weight x similarity
+over the services they used, and the best RECOMMENDATIONS_PER_USER are
+written to the User_Recommendations table, one row per user. The
+dashboard reads them through an in-memory map.
+
+Similarities are computed with SciPy sparse products when NumPy and SciPy
+are installed and with plain dictionaries otherwise.
+"""
+import heapq
+import math
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from data_manager import TableCache
+from popularity import UNCOUNTED_STATUSES
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+TABLE = 'User_Recommendations'
+
+BOOKING_WEIGHT = 1.0
+# A five-star review adds this much, a one-star review takes it away
+REVIEW_WEIGHT = 1.0
+# Most similar services kept per service
+NEIGHBOURS = 30
+# Strongest services per user used for similarity; bounds the pairs one heavy user adds
+MAX_USER_ITEMS = 200
+RECOMMENDATIONS_PER_USER = 10
+
+def user_interactions(bookings, reviews):
+    """{user_id: {service_id: weight}} for every service a user booked or reviewed"""
+    interactions = {}
+    booking_services = {}
+    for booking in bookings:
+        booking_services[booking.get('id')] = booking.get('service_id')
+        weight = 0.0 if booking.get('booking_status') in UNCOUNTED_STATUSES else BOOKING_WEIGHT
+        services = interactions.setdefault(booking.get('user_id'), {})
+        services[booking.get('service_id')] = max(services.get(booking.get('service_id'), 0.0), weight)
+    for review in reviews:
+        if review.get('is_flagged', False) or not review.get('rating'):
+            continue
+        service_id = review.get('service_id', booking_services.get(review.get('booking_id')))
+        services = interactions.setdefault(review.get('user_id'), {})
+        services[service_id] = services.get(service_id, 0.0) + REVIEW_WEIGHT * (review['rating'] - 3) / 2
+    for services in interactions.values():
+        services.pop(None, None)
+    interactions.pop(None, None)
+    return interactions
+
+def _strongest(services):
+    return sorted(services.items(), key=lambda item: (-item[1], item[0]))[:MAX_USER_ITEMS]
+
+def _neighbours_python(profiles):
+    dots = {}
+    norms = {}
+    for items in profiles:
+        for position, (service_id, weight) in enumerate(items):
+            norms[service_id] = norms.get(service_id, 0.0) + weight * weight
+            for other_id, other_weight in items[position + 1:]:
+                product = weight * other_weight
+                row = dots.setdefault(service_id, {})
+                row[other_id] = row.get(other_id, 0.0) + product
+                row = dots.setdefault(other_id, {})
+                row[service_id] = row.get(service_id, 0.0) + product
+    neighbours = {}
+    for service_id, row in dots.items():
+        norm = math.sqrt(norms[service_id])
+        similar = ((dot / (norm * math.sqrt(norms[other_id])), other_id) for other_id, dot in row.items())
+        neighbours[service_id] = heapq.nsmallest(NEIGHBOURS, similar, key=lambda pair: (-pair[0], pair[1]))
+    return neighbours
+
+def _neighbours_sparse(profiles):
+    service_ids = sorted({service_id for items in profiles for service_id, weight in items})
+    index = {service_id: column for column, service_id in enumerate(service_ids)}
+    rows, columns, weights = [], [], []
+    for row, items in enumerate(profiles):
+        for service_id, weight in items:
+            rows.append(row)
+            columns.append(index[service_id])
+            weights.append(weight)
+    matrix = sparse.csr_matrix((weights, (rows, columns)), shape=(len(profiles), len(service_ids)))
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    normalised = matrix @ sparse.diags(1.0 / norms)
+    similarity = (normalised.T @ normalised).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+    ids = np.array(service_ids)
+    neighbours = {}
+    for column, service_id in enumerate(service_ids):
+        start, end = similarity.indptr[column], similarity.indptr[column + 1]
+        if start == end:
+            continue
+        others = ids[similarity.indices[start:end]]
+        values = similarity.data[start:end]
+        best = np.lexsort((others, -values))[:NEIGHBOURS]
+        neighbours[service_id] = [(float(values[i]), others[i].item()) for i in best]
+    return neighbours
+
+def build_recommendations(bookings, reviews):
+    """[(user_id, [service_id, ...])], best first, for every user with something to recommend"""
+    interactions = user_interactions(bookings, reviews)
+    profiles = {user_id: {service_id: weight for service_id, weight in services.items() if weight > 0}
+                for user_id, services in interactions.items()}
+    # Only users with two or more services tie services together
+    shared = [_strongest(services) for services in profiles.values() if len(services) > 1]
+    neighbours = _neighbours_sparse(shared) if sparse is not None and shared else _neighbours_python(shared)
+
+    results = []
+    for user_id in sorted(profiles):
+        scores = {}
+        for service_id, weight in profiles[user_id].items():
+            for similarity, other_id in neighbours.get(service_id, ()):
+                scores[other_id] = scores.get(other_id, 0.0) + weight * similarity
+        seen = interactions[user_id]
+        best = heapq.nsmallest(RECOMMENDATIONS_PER_USER, (s for s in scores if s not in seen),
+                               key=lambda service_id: (-scores[service_id], service_id))
+        if best:
+            results.append((user_id, best))
+    return results
+
+def refresh_recommendations(db):
+    """Recompute and store every user's recommendations; returns the number of users"""
+    results = build_recommendations(db.get_all('Bookings'), db.get_all('Reviews'))
+    generated_at = datetime.now().isoformat()
+    return db.replace_all(TABLE, [{'user_id': user_id, 'service_ids': service_ids, 'generated_at': generated_at}
+                                  for user_id, service_ids in results])
+
+class PersonalRecommendations(TableCache):
+    tables = (TABLE,)
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._by_user = {}
+
+    def for_user(self, user_id):
+        """Service ids last recommended to user_id, best first"""
+        self.ensure_fresh()
+        with self.lock:
+            return self._by_user.get(user_id, [])
+
+    def _rebuild(self):
+        self._by_user = {row.get('user_id'): row.get('service_ids', []) for row in self.db.get_all(TABLE)}
+
+recommendations_cli = AppGroup('recommendations', help='Build personal service recommendations.')
+
+@recommendations_cli.command('build')
+def build_command():
+    """Recompute every user's recommendations from bookings and reviews"""
+    start = time.perf_counter()
+    users = refresh_recommendations(current_app.db)
+    engine = 'SciPy' if sparse is not None else 'pure Python'
+    click.echo(f"Stored recommendations for {users} user(s) in {time.perf_counter() - start:.1f}s ({engine})")
@@ -0,0 +1,64 @@
+"""ETag / If-None-Match for polled JSON endpoints.
+
+A polled endpoint builds its JSON as usual and passes it through
+``etag_response``. The ETag is a digest of the body, so any change the
+client could see (new rows, edits, read flags, sender names) gives a new
+tag, and an unchanged body is answered with 304 Not Modified and no body.
+
+To skip even building the body, ``VersionedEtags`` remembers which ETag
+was served for a key (e.g. user and booking) at a given set of table file
+versions. While none of those tables has been written, a poll carrying
+that ETag is answered with 304 straight away, without reading any rows.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app, request
+
+def not_modified(etag):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+def etag_response(response):
+    """Tag a response with a digest of its body; 304 if the client has it already"""
+    etag = hashlib.sha1(response.get_data()).hexdigest()
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    response.set_etag(etag)
+    return response
+
+class VersionedEtags:
+    """Last ETag served per key, valid while the given tables are unchanged"""
+
+    def __init__(self, db, tables, size=4096):
+        self.db = db
+        self.tables = tuple(tables)
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def versions(self):
+        return tuple(self.db.table_version(table_name) for table_name in self.tables)
+
+    def unchanged(self, key, versions):
+        """The ETag to answer 304 with, if the client already holds the current one"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != versions:
+                return None
+            self.entries.move_to_end(key)
+        etag = entry[1]
+        return etag if request.if_none_match.contains(etag) else None
+
+    def remember(self, key, versions, response):
+        """Record the ETag of a response built after reading versions"""
+        etag, weak = response.get_etag()
+        if etag is None:
+            return
+        with self.lock:
+            self.entries[key] = (versions, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
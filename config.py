@@ -3,5 +3,50 @@ import os
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'a_very_secret_key_that_should_be_changed_in_production'
     JSON_DATABASE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data')
+    BACKUP_DIR = os.environ.get('BACKUP_DIR') or os.path.join(os.path.abspath(os.path.dirname(__file__)), 'backups')
 
+    # Landing page stats are rebuilt at least this often (seconds) even if no table changed
+    PLATFORM_STATS_TTL = 300
 
+    # DataManager call auditing (query_audit.py); None means "only when app.debug"
+    DB_AUDIT_ENABLED = None
+    DB_AUDIT_NPLUSONE_THRESHOLD = 3
+    DB_CALL_BUDGET = 25
+    DB_CALL_BUDGETS = {
+        'user_dashboard': 10,
+        'provider_dashboard': 10,
+        'services.browse': 8,
+        'chat.conversations': 8,
+    }
+    # Raise instead of logging when a route goes over budget (for tests)
+    DB_CALL_BUDGET_STRICT = False
+
+    # Fraction of requests timed for the admin performance page (performance.py)
+    PERF_SAMPLE_RATE = float(os.environ.get('PERF_SAMPLE_RATE', '0.05'))
+
+    # On-demand request profiles (profiler.py); PROFILE_TOKEN allows profiling via the X-Profile-Token header
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(os.path.abspath(os.path.dirname(__file__)), 'profiles')
+    PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+    # Captures kept in PROFILE_DIR; the oldest are deleted as new ones are saved
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '100'))
+
+    # Prometheus metrics (metrics.py); each gunicorn worker writes its figures to METRICS_DIR
+    METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(os.path.abspath(os.path.dirname(__file__)), 'metrics')
+    METRICS_FLUSH_INTERVAL = 5.0
+    # Bearer token required to scrape /metrics; without one only local scrapes are answered
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # Request tracing (tracing.py): share of requests traced and where traces are written
+    TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.0'))
+    # Let a caller's sampled traceparent force a trace; only for deployments behind trusted callers
+    TRACE_TRUST_PARENT = os.environ.get('TRACE_TRUST_PARENT', '').lower() in ('1', 'true', 'yes')
+    TRACE_DIR = os.environ.get('TRACE_DIR') or os.path.join(os.path.abspath(os.path.dirname(__file__)), 'traces')
+    # Trace files older than this many days are deleted as new ones are started
+    TRACE_RETENTION_DAYS = int(os.environ.get('TRACE_RETENTION_DAYS', '7'))
+
+    # Service page views are counted in memory and written to Service_Views at most this often (seconds)
+    VIEW_FLUSH_INTERVAL = 30.0
+
+class DevelopmentConfig(Config):
+    # Time every request locally
+    PERF_SAMPLE_RATE = float(os.environ.get('PERF_SAMPLE_RATE', '1.0'))
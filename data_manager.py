@@ -1,74 +1,369 @@
 
+import contextlib
+import functools
 import json
 import os
+import tempfile
 import threading
+import time
+import weakref
+from storage_stats import StorageStats
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): writers are only serialised within one process
+    fcntl = None
+
+class WriteLock:
+    """Serialises read-modify-write cycles on one table across threads and processes.
+
+    A reentrant thread lock orders this process's writers and an exclusive
+    flock on a lock file next to the table orders them against other
+    processes (gunicorn workers, flask CLI commands) sharing the data
+    directory. The lock file is opened per acquisition, and a child made
+    by fork drops the descriptors it inherited, so parent and child never
+    share one lock.
+    """
+    _instances = weakref.WeakSet()
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+        WriteLock._instances.add(self)
+
+    @classmethod
+    def _after_fork_in_child(cls):
+        for write_lock in list(cls._instances):
+            if write_lock._fd is not None:
+                # Only close: unlocking would release the parent's flock
+                os.close(write_lock._fd)
+                write_lock._fd = None
+            write_lock._lock = threading.RLock()
+            write_lock._depth = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            except BaseException:
+                self._lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            # Closing the descriptor releases the flock
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=WriteLock._after_fork_in_child)
 
 class DataManager:
     def __init__(self, db_dir):
         self.db_dir = db_dir
         os.makedirs(self.db_dir, exist_ok=True)
         self.locks = {}
+        self.write_locks = {}
+        self.listeners = {}
+        self.stats = StorageStats()
+        # Set by identity_map.init_app; returns the active request's IdentityMap
+        self.identity_map_provider = None
+        # Callables run after every table access as hook(table_name, method, elapsed, scanned, returned)
+        self.call_hooks = []
+        # TableCache instances built on this DataManager (for memory reporting)
+        self.caches = []
 
     def _get_file_path(self, table_name):
         return os.path.join(self.db_dir, f'{table_name}.json')
 
     def _get_lock(self, table_name):
         if table_name not in self.locks:
-            self.locks[table_name] = threading.Lock()
+            self.locks.setdefault(table_name, threading.Lock())
         return self.locks[table_name]
 
+    def _get_write_lock(self, table_name):
+        """Lock held from reading a table to notifying listeners of the write"""
+        if table_name not in self.write_locks:
+            self.write_locks.setdefault(table_name, WriteLock(os.path.join(self.db_dir, f'.{table_name}.lock')))
+        return self.write_locks[table_name]
+
+    def table_names(self):
+        return sorted(name[:-len('.json')] for name in os.listdir(self.db_dir) if name.endswith('.json'))
+
+    @contextlib.contextmanager
+    def lock_tables(self, table_names):
+        """Hold the write locks of several tables at once (always taken in sorted order).
+
+        These are the locks every writer takes, in any process sharing the
+        data directory, so no table changes until the block ends.
+        """
+        with contextlib.ExitStack() as stack:
+            for table_name in sorted(set(table_names)):
+                stack.enter_context(self._get_write_lock(table_name))
+            yield
+
     def _read_data(self, table_name):
         file_path = self._get_file_path(table_name)
         if not os.path.exists(file_path):
             return []
+        wait_start = time.perf_counter()
         with self._get_lock(table_name):
-            with open(file_path, 'r') as f:
-                return json.load(f)
+            acquired = time.perf_counter()
+            with open(file_path, 'rb') as f:
+                raw = f.read()
+            parse_start = time.perf_counter()
+            data = json.loads(raw)
+            released = time.perf_counter()
+        self.stats.record_read(table_name, len(raw), parse=released - parse_start,
+                               wait=acquired - wait_start, hold=released - acquired)
+        return data
 
     def _write_data(self, table_name, data):
         file_path = self._get_file_path(table_name)
+        dump_start = time.perf_counter()
+        raw = json.dumps(data, indent=4).encode('utf-8')
+        wait_start = time.perf_counter()
         with self._get_lock(table_name):
-            with open(file_path, 'w') as f:
-                json.dump(data, f, indent=4)
+            acquired = time.perf_counter()
+            self._replace_file(file_path, lambda f: f.write(raw))
+            released = time.perf_counter()
+        self.stats.record_write(table_name, len(raw), dump=wait_start - dump_start,
+                                wait=acquired - wait_start, hold=released - acquired)
+
+    def _replace_file(self, file_path, write):
+        # Write a new file and rename it over the old one, so readers never
+        # see a half-written table and an existing file's contents never
+        # change in place (snapshots rely on that to hard-link table files).
+        fd, tmp_path = tempfile.mkstemp(dir=self.db_dir, prefix='.' + os.path.basename(file_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            try:
+                os.chmod(tmp_path, os.stat(file_path).st_mode & 0o777)
+            except FileNotFoundError:
+                os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+    def table_version(self, table_name):
+        """Cheap change token for a table file; differs after every write"""
+        try:
+            stat = os.stat(self._get_file_path(table_name))
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def add_listener(self, table_name, callback):
+        """Register callback(action, item, previous) to run after each write to a table"""
+        self.listeners.setdefault(table_name, []).append(callback)
+
+    def _identity_map(self):
+        return self.identity_map_provider() if self.identity_map_provider else None
+
+    def _notify(self, table_name, action, item, previous=None):
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            identity_map.invalidate(table_name)
+        for callback in self.listeners.get(table_name, []):
+            callback(action, item, previous)
+
+    def _record_call(self, table_name, method, start, scanned, returned):
+        elapsed = time.perf_counter() - start
+        self.stats.record_call(table_name, method, elapsed, scanned, returned)
+        for hook in self.call_hooks:
+            hook(table_name, method, elapsed, scanned, returned)
 
     def get_all(self, table_name):
-        return self._read_data(table_name)
+        start = time.perf_counter()
+        data = self._read_data(table_name)
+        self._record_call(table_name, 'get_all', start, len(data), len(data))
+        return data
 
     def get_by_id(self, table_name, item_id):
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            found, result = identity_map.lookup(table_name, 'id', item_id)
+            if found:
+                return result
+        start = time.perf_counter()
         data = self._read_data(table_name)
-        return next((item for item in data if item.get('id') == item_id), None)
+        result = next((item for item in data if item.get('id') == item_id), None)
+        self._record_call(table_name, 'get_by_id', start, len(data), 1 if result else 0)
+        if identity_map is not None:
+            identity_map.store(table_name, 'id', item_id, result)
+        return result
 
     def add(self, table_name, item):
-        data = self._read_data(table_name)
-        new_id = 1
-        if data:
-            new_id = max(item.get('id', 0) for item in data) + 1
-        item['id'] = new_id
-        data.append(item)
-        self._write_data(table_name, data)
+        start = time.perf_counter()
+        with self._get_write_lock(table_name):
+            data = self._read_data(table_name)
+            new_id = 1
+            if data:
+                new_id = max(item.get('id', 0) for item in data) + 1
+            item['id'] = new_id
+            data.append(item)
+            self._write_data(table_name, data)
+            self._notify(table_name, 'add', item)
+        self._record_call(table_name, 'add', start, len(data) - 1, 1)
         return item
 
     def update(self, table_name, item_id, updates):
-        data = self._read_data(table_name)
-        for i, item in enumerate(data):
-            if item.get('id') == item_id:
-                item.update(updates)
-                self._write_data(table_name, data)
-                return item
+        start = time.perf_counter()
+        with self._get_write_lock(table_name):
+            data = self._read_data(table_name)
+            for i, item in enumerate(data):
+                if item.get('id') == item_id:
+                    previous = dict(item)
+                    item.update(updates)
+                    self._write_data(table_name, data)
+                    self._notify(table_name, 'update', item, previous)
+                    self._record_call(table_name, 'update', start, len(data), 1)
+                    return item
+        self._record_call(table_name, 'update', start, len(data), 0)
         return None
 
     def delete(self, table_name, item_id):
-        data = self._read_data(table_name)
-        original_len = len(data)
-        data = [item for item in data if item.get('id') != item_id]
-        if len(data) < original_len:
-            self._write_data(table_name, data)
-            return True
-        return False
+        start = time.perf_counter()
+        with self._get_write_lock(table_name):
+            data = self._read_data(table_name)
+            removed = [item for item in data if item.get('id') == item_id]
+            if removed:
+                remaining = [item for item in data if item.get('id') != item_id]
+                self._write_data(table_name, remaining)
+                for item in removed:
+                    self._notify(table_name, 'delete', item)
+        self._record_call(table_name, 'delete', start, len(data), len(removed))
+        return bool(removed)
+
+    def add_counts(self, table_name, key_fields, deltas, field='count'):
+        """Add counter deltas in one read and one write.
+
+        deltas maps a tuple of key_fields values to the amount to add to
+        field of the row with those values; missing rows are created.
+        Returns the number of rows touched. The write lock keeps other
+        workers' increments from being lost between the read and the write.
+        """
+        start = time.perf_counter()
+        with self._get_write_lock(table_name):
+            data = self._read_data(table_name)
+            rows = {tuple(item.get(key_field) for key_field in key_fields): item for item in data}
+            next_id = max((item.get('id', 0) for item in data), default=0) + 1
+            changes = []
+            for key, delta in deltas.items():
+                row = rows.get(key)
+                if row is None:
+                    row = rows[key] = dict(zip(key_fields, key), id=next_id)
+                    next_id += 1
+                    data.append(row)
+                    changes.append(('add', row, None))
+                else:
+                    changes.append(('update', row, dict(row)))
+                row[field] = row.get(field, 0) + delta
+            if changes:
+                self._write_data(table_name, data)
+                for action, row, previous in changes:
+                    self._notify(table_name, action, row, previous)
+        self._record_call(table_name, 'add_counts', start, len(data), len(changes))
+        return len(changes)
+
+    def replace_all(self, table_name, rows):
+        """Swap a table's contents for rows in one write (for batch-built tables).
+
+        Ids are assigned in order. Listeners are not called for each row;
+        caches over the table see its new version token and rebuild.
+        """
+        start = time.perf_counter()
+        rows = [dict(row, id=index) for index, row in enumerate(rows, 1)]
+        with self._get_write_lock(table_name):
+            self._write_data(table_name, rows)
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            identity_map.invalidate(table_name)
+        self._record_call(table_name, 'replace_all', start, 0, len(rows))
+        return len(rows)
 
     def find_by_attribute(self, table_name, attribute, value):
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            found, result = identity_map.lookup(table_name, attribute, value)
+            if found:
+                return result
+        start = time.perf_counter()
+        data = self._read_data(table_name)
+        result = [item for item in data if item.get(attribute) == value]
+        self._record_call(table_name, 'find_by_attribute', start, len(data), len(result))
+        if identity_map is not None:
+            identity_map.store(table_name, attribute, value, result)
+        return result
+
+    def get_by_ids(self, table_name, item_ids):
+        """Fetch several rows of one table with a single read; returns {id: row}"""
+        item_ids = set(item_ids)
+        identity_map = self._identity_map()
+        result = {}
+        if identity_map is not None:
+            for item_id in list(item_ids):
+                found, row = identity_map.lookup(table_name, 'id', item_id)
+                if found:
+                    if row is not None:
+                        result[item_id] = row
+                    item_ids.discard(item_id)
+        if not item_ids:
+            return result
+
+        start = time.perf_counter()
         data = self._read_data(table_name)
-        return [item for item in data if item.get(attribute) == value]
+        fetched = {item.get('id'): item for item in data if item.get('id') in item_ids}
+        self._record_call(table_name, 'get_by_ids', start, len(data), len(fetched))
+        if identity_map is not None:
+            for item_id in item_ids:
+                identity_map.store(table_name, 'id', item_id, fetched.get(item_id))
+        result.update(fetched)
+        return result
+
+    def load_related(self, rows, relations):
+        """Attach related rows to each row, reading every referenced table once.
+
+        relations maps the key to set on each row to a tuple of
+        (table_name, foreign_key_field) to attach the whole related row
+        (None if missing), or (table_name, foreign_key_field, field, default)
+        to attach a single field of it.
+        """
+        wanted = {}
+        for relation in relations.values():
+            table_name, fk_field = relation[0], relation[1]
+            wanted.setdefault(table_name, set()).update(
+                row.get(fk_field) for row in rows if row.get(fk_field) is not None)
+
+        related = {table_name: self.get_by_ids(table_name, ids) for table_name, ids in wanted.items()}
+
+        for row in rows:
+            for key, relation in relations.items():
+                table_name, fk_field = relation[0], relation[1]
+                target = related[table_name].get(row.get(fk_field))
+                if len(relation) == 2:
+                    row[key] = target
+                else:
+                    field, default = relation[2], relation[3]
+                    row[key] = target.get(field, default) if target else default
+        return rows
 
     def _validate_foreign_key(self, ref_table, ref_id):
         if not self.get_by_id(ref_table, ref_id):
@@ -79,13 +374,15 @@ class DataManager:
             for fk_table, fk_id_field in foreign_keys.items():
                 self._validate_foreign_key(fk_table, item.get(fk_id_field))
 
-        if unique_fields:
-            data = self._read_data(table_name)
-            for field in unique_fields:
-                if any(d.get(field) == item.get(field) for d in data):
-                    raise ValueError(f"Unique constraint failed: {field} '{item.get(field)}' already exists in {table_name}")
-        
-        return self.add(table_name, item)
+        # Held across the check and the insert, so two workers can't both pass it
+        with self._get_write_lock(table_name):
+            if unique_fields:
+                data = self._read_data(table_name)
+                for field in unique_fields:
+                    if any(d.get(field) == item.get(field) for d in data):
+                        raise ValueError(f"Unique constraint failed: {field} '{item.get(field)}' already exists in {table_name}")
+
+            return self.add(table_name, item)
 
     def update_with_validation(self, table_name, item_id, updates, foreign_keys=None, unique_fields=None):
         if foreign_keys:
@@ -93,13 +390,71 @@ class DataManager:
                 if fk_id_field in updates:
                     self._validate_foreign_key(fk_table, updates.get(fk_id_field))
 
-        if unique_fields:
-            data = self._read_data(table_name)
-            for field in unique_fields:
-                if field in updates:
-                    if any(d.get(field) == updates.get(field) and d.get('id') != item_id for d in data):
-                        raise ValueError(f"Unique constraint failed: {field} '{updates.get(field)}' already exists in {table_name}")
+        with self._get_write_lock(table_name):
+            if unique_fields:
+                data = self._read_data(table_name)
+                for field in unique_fields:
+                    if field in updates:
+                        if any(d.get(field) == updates.get(field) and d.get('id') != item_id for d in data):
+                            raise ValueError(f"Unique constraint failed: {field} '{updates.get(field)}' already exists in {table_name}")
+
+            return self.update(table_name, item_id, updates)
+
+
+class TableCache:
+    """In-memory state derived from one or more tables.
 
-        return self.update(table_name, item_id, updates)
+    Subclasses list their source ``tables`` and implement ``_rebuild``.
+    Writes made through the owning DataManager are handed to ``_apply`` so
+    the state can be patched in place; if ``_apply`` returns False the state
+    is rebuilt on next access instead. Writes from other processes (other
+    gunicorn workers) are caught by comparing ``table_version`` tokens.
+    Setting ``ttl`` (seconds) also rebuilds state older than that, as a
+    backstop for table files edited outside DataManager.
+    """
+    tables = ()
+    ttl = None
 
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.RLock()
+        self._versions = None
+        self._built_at = 0.0
+        db.caches.append(self)
+        for table_name in self.tables:
+            db.add_listener(table_name, functools.partial(self._on_write, table_name))
 
+    def _current_versions(self):
+        return {table_name: self.db.table_version(table_name) for table_name in self.tables}
+
+    def ensure_fresh(self):
+        """Rebuild the derived state if any source table changed behind our back"""
+        versions = self._current_versions()
+        with self.lock:
+            hit = versions == self._versions and (self.ttl is None or time.monotonic() - self._built_at < self.ttl)
+            if not hit:
+                # Record the versions seen *before* reading, so a write that
+                # lands mid-rebuild is picked up on the next access.
+                self._rebuild()
+                self._versions = versions
+                self._built_at = time.monotonic()
+        self.db.stats.record_cache(type(self).__name__, hit)
+
+    def invalidate(self):
+        with self.lock:
+            self._versions = None
+
+    def _on_write(self, table_name, action, item, previous):
+        with self.lock:
+            if self._versions is None:
+                return
+            if self._apply(table_name, action, item, previous):
+                self._versions[table_name] = self.db.table_version(table_name)
+            else:
+                self._versions = None
+
+    def _rebuild(self):
+        raise NotImplementedError
+
+    def _apply(self, table_name, action, item, previous):
+        return False
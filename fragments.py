@@ -0,0 +1,71 @@
+"""Cached per-provider parts of the service detail page.
+
+A provider's rating, completed job count and rendered review list are the
+same for every visitor and every one of the provider's services, so they
+are built once per provider and kept until one of that provider's reviews
+or bookings changes, or a reviewer renames themselves. Other writes leave
+the entry alone. Entries are evicted least recently used beyond ``size``.
+"""
+from collections import OrderedDict
+
+from flask import render_template
+from markupsafe import Markup
+
+from data_manager import TableCache
+
+class ProviderSummaries(TableCache):
+    tables = ('Reviews', 'Bookings', 'Users')
+
+    def __init__(self, db, ratings, size=1024):
+        super().__init__(db)
+        self.ratings = ratings
+        self.size = size
+        self._entries = OrderedDict()
+
+    def get(self, provider_id):
+        """{'average_rating', 'review_count', 'completed_jobs', 'reviews_html'} for provider_id"""
+        self.ensure_fresh()
+        with self.lock:
+            entry = self._entries.get(provider_id)
+            if entry is not None:
+                self._entries.move_to_end(provider_id)
+                self.db.stats.record_cache('ProviderSummaries.entry', True)
+                return entry['summary']
+        self.db.stats.record_cache('ProviderSummaries.entry', False)
+        versions = self._current_versions()
+        entry = self._build(provider_id)
+        with self.lock:
+            # Only keep it if nothing was written while it was being built
+            if versions == self._versions:
+                self._entries[provider_id] = entry
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return entry['summary']
+
+    def _build(self, provider_id):
+        reviews = [r for r in self.db.find_by_attribute('Reviews', 'provider_id', provider_id)
+                   if not r.get('is_flagged', False)]
+        authors = self.db.get_by_ids('Users', {r.get('user_id') for r in reviews})
+        reviews = [dict(r, user=authors.get(r.get('user_id')) or {'name': 'Anonymous'}) for r in reviews]
+        rating = self.ratings.for_provider(provider_id)
+        bookings = self.db.find_by_attribute('Bookings', 'provider_id', provider_id)
+        summary = {
+            'average_rating': rating['average'],
+            'review_count': rating['count'],
+            'completed_jobs': len([b for b in bookings if b.get('booking_status') == 'completed']),
+            'reviews_html': Markup(render_template('services/provider_reviews.html', reviews=reviews,
+                                                   average_rating=rating['average'], review_count=rating['count']))
+        }
+        return {'summary': summary, 'authors': set(authors)}
+
+    def _rebuild(self):
+        self._entries = OrderedDict()
+
+    def _apply(self, table_name, action, item, previous):
+        if table_name == 'Users':
+            stale = [provider_id for provider_id, entry in self._entries.items() if item['id'] in entry['authors']]
+        else:
+            stale = {row.get('provider_id') for row in (item, previous) if row}
+        for provider_id in stale:
+            self._entries.pop(provider_id, None)
+        return True
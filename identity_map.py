@@ -0,0 +1,59 @@
+from flask import g, has_request_context
+
+class IdentityMap:
+    """Memo of get_by_id / find_by_attribute results for one request.
+
+    Callers get copies of the memoised rows, so a view that decorates a row
+    (e.g. booking["service"] = ...) doesn't leak into later lookups. Any
+    write to a table drops everything memoised for that table.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, table_name, attribute, value):
+        """Return (found, result) for a memoised lookup"""
+        key = (table_name, attribute, value)
+        if key not in self.entries:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, self._copy(self.entries[key])
+
+    def store(self, table_name, attribute, value, result):
+        self.entries[(table_name, attribute, value)] = self._copy(result)
+        if attribute != 'id' and isinstance(result, list):
+            # Rows found by attribute also answer later get_by_id calls
+            for row in result:
+                if 'id' in row:
+                    self.entries[(table_name, 'id', row['id'])] = dict(row)
+
+    def invalidate(self, table_name):
+        self.entries = {key: value for key, value in self.entries.items() if key[0] != table_name}
+
+    def _copy(self, result):
+        if isinstance(result, list):
+            return [dict(row) for row in result]
+        return dict(result) if result is not None else None
+
+def current_identity_map():
+    """The identity map of the active request, created on first use"""
+    if not has_request_context():
+        return None
+    if 'identity_map' not in g:
+        g.identity_map = IdentityMap()
+    return g.identity_map
+
+def init_app(app):
+    app.db.identity_map_provider = current_identity_map
+
+    @app.teardown_request
+    def report_identity_map(exc):
+        identity_map = g.pop('identity_map', None)
+        if identity_map is None:
+            return
+        app.db.stats.record_dedup(identity_map.hits, identity_map.misses)
+        if identity_map.hits:
+            app.logger.debug('Identity map saved %d of %d lookups', identity_map.hits, identity_map.hits + identity_map.misses)
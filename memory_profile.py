@@ -0,0 +1,142 @@
+"""Memory usage of a worker: tracemalloc snapshots and data footprints.
+
+tracemalloc slows every allocation down, so it is only running between an
+admin pressing start and stop on /admin/memory. Each snapshot is compared
+with the previous one to show which lines of code allocated the growth.
+
+Table and cache sizes are estimates from a recursive sys.getsizeof walk:
+for a table, the size of its rows once parsed (what every request reading
+the table holds while it runs); for a TableCache, the size of its derived
+state. Figures are for this worker process only.
+"""
+import json
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+from datetime import datetime
+
+# Allocation sites from these files are noise from the profiler itself
+_IGNORED_FILES = ('<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>', '<unknown>',
+                  tracemalloc.__file__)
+
+def deep_sizeof(obj, exclude=()):
+    """Approximate bytes held by obj and everything reachable from it, except through exclude"""
+    seen = {id(item) for item in exclude}
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, '__dict__') and not isinstance(item, type):
+            stack.append(vars(item))
+    return total
+
+def table_footprints(db):
+    """Rows, file size and estimated parsed size of every table"""
+    footprints = []
+    for table_name in db.table_names():
+        path = db._get_file_path(table_name)
+        try:
+            # Table files are replaced atomically, so no lock is needed to read one
+            with open(path, 'rb') as f:
+                raw = f.read()
+            rows = json.loads(raw) if raw.strip() else []
+        except (OSError, ValueError):
+            continue
+        footprints.append({
+            'table': table_name,
+            'rows': len(rows),
+            'file_bytes': len(raw),
+            'memory_bytes': deep_sizeof(rows)
+        })
+    return sorted(footprints, key=lambda f: -f['memory_bytes'])
+
+def cache_footprints(db):
+    """Estimated size of the derived state of every TableCache on db"""
+    footprints = []
+    for cache in db.caches:
+        state = {name: value for name, value in vars(cache).items() if name not in ('db', 'lock')}
+        # Caches hold references to the caches they are built from; those are measured on their own
+        others = [db] + [other for other in db.caches if other is not cache]
+        footprints.append({
+            'cache': type(cache).__name__,
+            'tables': list(cache.tables),
+            'loaded': cache._versions is not None,
+            'memory_bytes': deep_sizeof(state, exclude=others)
+        })
+    return sorted(footprints, key=lambda f: -f['memory_bytes'])
+
+def process_memory():
+    """Current and peak resident set size of this process, in bytes"""
+    current = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024  # ru_maxrss is in kilobytes on Linux
+    return {'rss': current, 'peak_rss': max(peak, current or 0)}
+
+def _site(stat):
+    frame = stat.traceback[0]
+    return f'{frame.filename}:{frame.lineno}'
+
+class MemoryProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.previous = None
+        self.report = None
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.previous = None
+            self.report = None
+
+    def stop(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.previous = None
+
+    def take_snapshot(self, limit=25):
+        """Snapshot allocations and diff them against the previous snapshot"""
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                return None
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, filename) for filename in _IGNORED_FILES])
+            current, peak = tracemalloc.get_traced_memory()
+            top = snapshot.statistics('lineno')
+            growth = snapshot.compare_to(self.previous, 'lineno') if self.previous is not None else []
+            self.report = {
+                'taken_at': datetime.now().isoformat(),
+                'compared': self.previous is not None,
+                'traced_current': current,
+                'traced_peak': peak,
+                'top': [{'site': _site(stat), 'size': stat.size, 'count': stat.count} for stat in top[:limit]],
+                'growth': [{'site': _site(stat), 'size_diff': stat.size_diff, 'size': stat.size,
+                            'count_diff': stat.count_diff}
+                           for stat in growth[:limit] if stat.size_diff]
+            }
+            self.previous = snapshot
+            return self.report
+
+def init_app(app):
+    app.memory_profiler = MemoryProfiler()
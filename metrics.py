@@ -0,0 +1,317 @@
+"""Prometheus text-format metrics at /metrics.
+
+Each worker counts its own requests and reads its DataManager's
+StorageStats. Under gunicorn every worker also writes its figures to
+METRICS_DIR/<pid>-<start>.json (at most every METRICS_FLUSH_INTERVAL
+seconds; the start time keeps a worker that reuses a pid from overwriting
+the file of the exited one), and whichever worker answers the scrape adds
+up the files of all workers: counters and histograms are summed,
+including those of workers that have since exited, and gauges are summed
+over live workers only. When the file of a long-exited worker is pruned
+its counters and histograms are first added to METRICS_DIR/retired.json,
+so no counter ever goes backwards. The DataManager figures come from
+StorageStats totals, which the admin storage stats reset leaves alone.
+
+Other modules report point-in-time values with ``register_gauge``.
+
+With METRICS_TOKEN set, scrapes need an ``Authorization: Bearer <token>``
+header; without it, only local scrapes are answered.
+"""
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import Response, abort, current_app, g, request
+from data_manager import WriteLock
+from storage_stats import Histogram
+
+# Files of exited workers are folded into RETIRED_FILE after this long
+STALE_WORKER_SECONDS = 3600
+RETIRED_FILE = 'retired.json'
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests handled, by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint'),
+    'datamanager_operations_total': ('counter', 'DataManager calls by table and method'),
+    'datamanager_operation_duration_seconds': ('histogram', 'DataManager call latency by table and method'),
+    'datamanager_rows_scanned_total': ('counter', 'Rows examined by DataManager calls'),
+    'datamanager_rows_returned_total': ('counter', 'Rows returned by DataManager calls'),
+    'datamanager_bytes_read_total': ('counter', 'Bytes of table files read'),
+    'datamanager_bytes_written_total': ('counter', 'Bytes of table files written'),
+    'datamanager_lock_wait_seconds': ('histogram', 'Time spent waiting for a table lock'),
+    'datamanager_lock_hold_seconds': ('histogram', 'Time a table lock was held'),
+    'datamanager_parse_seconds': ('histogram', 'Time spent parsing table files'),
+    'datamanager_dump_seconds': ('histogram', 'Time spent serialising table files'),
+    'cache_lookups_total': ('counter', 'TableCache freshness checks by result'),
+    'cache_hit_ratio': ('gauge', 'Share of TableCache lookups served without a rebuild'),
+    'identity_map_lookups_total': ('counter', 'Per-request identity map lookups by result'),
+    'metrics_workers': ('gauge', 'Live workers whose metrics are included')
+}
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _merge_samples(totals, data):
+    """Add a worker file's counters and histograms to totals ({kind: {name: {labels key: value}}})"""
+    for name, samples in data.get('counters', {}).items():
+        merged = totals.setdefault('counters', {}).setdefault(name, {})
+        for labels, value in samples:
+            key = _labels_key(dict(labels))
+            merged[key] = merged.get(key, 0) + value
+    for name, samples in data.get('histograms', {}).items():
+        merged = totals.setdefault('histograms', {}).setdefault(name, {})
+        for labels, value in samples:
+            key = _labels_key(dict(labels))
+            total = merged.setdefault(key, {'buckets': {}, 'sum': 0.0, 'count': 0})
+            for bound, count in value['buckets'].items():
+                total['buckets'][bound] = total['buckets'].get(bound, 0) + count
+            total['sum'] += value['sum']
+            total['count'] += value['count']
+    return totals
+
+class Metrics:
+    def __init__(self, db, metrics_dir=None, flush_interval=5.0):
+        self.db = db
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.gauges = {}
+        self.last_flush = 0.0
+        self.worker = None
+
+    def register_gauge(self, name, description, callback, labels=()):
+        """Report callback() as a gauge on every scrape.
+
+        callback returns a number, or, when label names are given, a dict of
+        {tuple of label values: number}.
+        """
+        HELP[name] = ('gauge', description)
+        self.gauges[name] = (callback, tuple(labels))
+
+    def observe_request(self, endpoint, method, status, elapsed):
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.durations.get(endpoint)
+            if histogram is None:
+                histogram = self.durations[endpoint] = Histogram()
+            histogram.observe(elapsed)
+
+    def collect(self):
+        """This worker's samples: {'counters'|'histograms'|'gauges': {name: [[labels, value], ...]}}"""
+        counters, histograms, gauges = {}, {}, {}
+
+        def add(kind, name, labels, value):
+            kind.setdefault(name, []).append([sorted(labels.items()), value])
+
+        with self.lock:
+            for (endpoint, method, status), count in self.requests.items():
+                add(counters, 'http_requests_total', {'endpoint': endpoint, 'method': method, 'status': str(status)}, count)
+            for endpoint, histogram in self.durations.items():
+                add(histograms, 'http_request_duration_seconds', {'endpoint': endpoint}, histogram.to_dict())
+
+        stats = self.db.stats.snapshot(totals=True)
+        for table_name, table in stats['tables'].items():
+            for method, count in table['calls'].items():
+                add(counters, 'datamanager_operations_total', {'table': table_name, 'method': method}, count)
+            for method, latency in table['latency'].items():
+                add(histograms, 'datamanager_operation_duration_seconds', {'table': table_name, 'method': method}, latency)
+            for field in ('rows_scanned', 'rows_returned', 'bytes_read', 'bytes_written'):
+                add(counters, f'datamanager_{field}_total', {'table': table_name}, table[field])
+            for field in ('lock_wait', 'lock_hold', 'parse_time', 'dump_time'):
+                name = f"datamanager_{field.replace('_time', '')}_seconds"
+                add(histograms, name, {'table': table_name}, table[field])
+        for cache_name, counts in stats['caches'].items():
+            add(counters, 'cache_lookups_total', {'cache': cache_name, 'result': 'hit'}, counts['hits'])
+            add(counters, 'cache_lookups_total', {'cache': cache_name, 'result': 'miss'}, counts['misses'])
+        add(counters, 'identity_map_lookups_total', {'result': 'hit'}, stats['identity_map']['hits'])
+        add(counters, 'identity_map_lookups_total', {'result': 'miss'}, stats['identity_map']['misses'])
+
+        for name, (callback, label_names) in self.gauges.items():
+            try:
+                value = callback()
+            except Exception:
+                current_app.logger.exception('Gauge %s failed', name)
+                continue
+            if label_names:
+                for label_values, sample in value.items():
+                    add(gauges, name, dict(zip(label_names, label_values)), sample)
+            else:
+                add(gauges, name, {}, value)
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def _worker_path(self):
+        # Named afresh in every process, as workers are forked after init_app
+        if self.worker is None or self.worker[0] != os.getpid():
+            self.worker = (os.getpid(), time.time_ns())
+        pid, started = self.worker
+        return os.path.join(self.metrics_dir, f'{pid}-{started}.json')
+
+    def flush(self, force=False):
+        """Write this worker's samples to METRICS_DIR (throttled unless forced)"""
+        now = time.time()
+        if not self.metrics_dir or (not force and now - self.last_flush < self.flush_interval):
+            return
+        self.last_flush = now
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        data = dict(self.collect(), pid=os.getpid(), written_at=now)
+        fd, tmp_path = tempfile.mkstemp(dir=self.metrics_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self._worker_path())
+
+    def _worker_samples(self):
+        """Samples of every worker plus the retired totals, retiring files of long-exited workers"""
+        if not self.metrics_dir:
+            return [(True, self.collect())]
+        self.flush(force=True)
+        workers = []
+        stale = []
+        for filename in os.listdir(self.metrics_dir):
+            if not filename.endswith('.json') or filename == RETIRED_FILE:
+                continue
+            data = _read_json(os.path.join(self.metrics_dir, filename))
+            if data is None:
+                continue
+            alive = _pid_alive(data['pid'])
+            if not alive and time.time() - data['written_at'] > STALE_WORKER_SECONDS:
+                stale.append(filename)
+                continue
+            workers.append((alive, data))
+        retired = self._retire(stale) if stale else _read_json(os.path.join(self.metrics_dir, RETIRED_FILE))
+        if retired is not None:
+            workers.append((False, retired))
+        return workers
+
+    def _retire(self, filenames):
+        """Fold the given worker files into RETIRED_FILE, delete them and return the new totals"""
+        retired_path = os.path.join(self.metrics_dir, RETIRED_FILE)
+        # Another worker answering a scrape may be retiring the same files
+        with WriteLock(os.path.join(self.metrics_dir, '.retired.lock')):
+            totals = _merge_samples({}, _read_json(retired_path) or {})
+            retired = []
+            for filename in filenames:
+                data = _read_json(os.path.join(self.metrics_dir, filename))
+                if data is not None:
+                    _merge_samples(totals, data)
+                    retired.append(filename)
+            data = {kind: {name: [[list(key), value] for key, value in samples.items()]
+                           for name, samples in totals.get(kind, {}).items()}
+                    for kind in ('counters', 'histograms')}
+            fd, tmp_path = tempfile.mkstemp(dir=self.metrics_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, retired_path)
+            for filename in retired:
+                os.remove(os.path.join(self.metrics_dir, filename))
+        return data
+
+    def render(self):
+        """Prometheus text exposition of all workers' samples"""
+        totals = {}
+        gauges = {}
+        live = 0
+        for alive, data in self._worker_samples():
+            live += alive
+            _merge_samples(totals, data)
+            if alive:
+                for name, samples in data['gauges'].items():
+                    merged = gauges.setdefault(name, {})
+                    for labels, value in samples:
+                        key = _labels_key(dict(labels))
+                        merged[key] = merged.get(key, 0) + value
+
+        counters, histograms = totals.get('counters', {}), totals.get('histograms', {})
+        lookups = counters.get('cache_lookups_total', {})
+        ratios = gauges.setdefault('cache_hit_ratio', {})
+        for cache_name in {dict(key)['cache'] for key in lookups}:
+            hits = lookups.get((('cache', cache_name), ('result', 'hit')), 0)
+            misses = lookups.get((('cache', cache_name), ('result', 'miss')), 0)
+            if hits + misses:
+                ratios[(('cache', cache_name),)] = round(hits / (hits + misses), 4)
+        gauges['metrics_workers'] = {(): live}
+
+        lines = []
+        for name, samples in sorted({**counters, **gauges}.items()):
+            kind, description = HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in sorted(samples.items()):
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        for name, samples in sorted(histograms.items()):
+            kind, description = HELP.get(name, ('histogram', name))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, value in sorted(samples.items()):
+                cumulative = 0
+                for bound, count in value['buckets'].items():
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(key)} {_format_value(round(value["sum"], 6))}')
+                lines.append(f'{name}_count{_format_labels(key)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+def _scrape_allowed():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        return hmac.compare_digest(supplied, f'Bearer {token}')
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+def init_app(app):
+    app.metrics = Metrics(app.db, app.config.get('METRICS_DIR'), app.config.get('METRICS_FLUSH_INTERVAL', 5.0))
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def count_request(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            metrics = current_app.metrics
+            metrics.observe_request(request.endpoint or 'unmatched', request.method,
+                                    response.status_code, time.perf_counter() - start)
+            metrics.flush()
+        return response
+
+    def metrics_view():
+        if not _scrape_allowed():
+            abort(403)
+        return Response(current_app.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,74 @@
+"""Page-number and keyset (cursor) pagination over a sorted list.
+
+Items must already be sorted by ``key`` (ascending, or descending with
+``reverse=True``) and the key must be unique, e.g. end in the row id. A
+cursor is the key of the last item on a page, so "the next page" stays
+correct even if rows are added or removed in front of it.
+"""
+import base64
+import bisect
+import json
+import math
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key), separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """The key a cursor was made from, or None if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    return tuple(key) if isinstance(key, list) else None
+
+class Page:
+    def __init__(self, items, number, limit, total, start, next_cursor):
+        self.items = items
+        self.number = number
+        self.limit = limit
+        self.total = total
+        self.start = start
+        self.next_cursor = next_cursor
+
+    @property
+    def pages(self):
+        return max(1, math.ceil(self.total / self.limit))
+
+    @property
+    def has_prev(self):
+        return self.start > 0
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def window(self, size=2):
+        """Page numbers around the current one, for the pagination links"""
+        return range(max(1, self.number - size), min(self.pages, self.number + size) + 1)
+
+def paginate(items, key, limit, page=1, cursor=None, reverse=False):
+    """The requested page of items; a valid cursor takes precedence over page"""
+    cursor_key = decode_cursor(cursor) if cursor else None
+    if cursor_key is not None:
+        keys = [key(item) for item in items]
+        try:
+            if reverse:
+                # Items after the cursor are those with a smaller key
+                keys.reverse()
+                start = len(keys) - bisect.bisect_left(keys, cursor_key)
+            else:
+                start = bisect.bisect_right(keys, cursor_key)
+        except TypeError:
+            # A cursor from a different sort order; start from the top
+            start = 0
+        page = start // limit + 1
+    else:
+        page = max(page, 1)
+        start = (page - 1) * limit
+
+    page_items = items[start:start + limit]
+    next_cursor = None
+    if start + limit < len(items) and page_items:
+        next_cursor = encode_cursor(key(page_items[-1]))
+    return Page(page_items, page, limit, len(items), start, next_cursor)
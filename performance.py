@@ -0,0 +1,123 @@
+"""Per-endpoint request latency, DataManager usage and render time.
+
+A sampled fraction of requests (PERF_SAMPLE_RATE) is timed from
+before_request to after_request. For each endpoint we keep a latency
+histogram, DataManager call counts and time, template render time and
+response sizes; the slowest recent requests are kept for the admin
+performance page. Figures are per worker process.
+"""
+import random
+import threading
+import time
+from collections import deque
+from flask import before_render_template, current_app, g, has_request_context, request, template_rendered
+from storage_stats import Histogram
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.render_time = Histogram()
+        self.db_calls = 0
+        self.db_time = 0.0
+        self.response_bytes = 0
+
+    def to_dict(self):
+        count = self.latency.count
+        return {
+            'count': count,
+            'p50': self.latency.quantile(0.5),
+            'p95': self.latency.quantile(0.95),
+            'p99': self.latency.quantile(0.99),
+            'max': self.latency.max,
+            'avg': self.latency.total / count if count else 0,
+            'avg_db_calls': self.db_calls / count if count else 0,
+            'avg_db_time': self.db_time / count if count else 0,
+            'avg_render_time': self.render_time.total / count if count else 0,
+            'avg_response_bytes': self.response_bytes / count if count else 0
+        }
+
+class PerformanceMonitor:
+    def __init__(self, recent_size=200):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.recent = deque(maxlen=recent_size)
+        self.started_at = time.time()
+
+    def record(self, endpoint, method, path, status, elapsed, db_calls, db_time, render_time, size):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.latency.observe(elapsed)
+            stats.render_time.observe(render_time)
+            stats.db_calls += db_calls
+            stats.db_time += db_time
+            stats.response_bytes += size
+            self.recent.append({
+                'endpoint': endpoint,
+                'method': method,
+                'path': path,
+                'status': status,
+                'elapsed': elapsed,
+                'db_calls': db_calls,
+                'render_time': render_time,
+                'size': size,
+                'at': time.time()
+            })
+
+    def summary(self, slowest=20):
+        with self.lock:
+            endpoints = {name: stats.to_dict() for name, stats in self.endpoints.items()}
+            recent = list(self.recent)
+        return {
+            'endpoints': dict(sorted(endpoints.items(), key=lambda item: -item[1]['p95'])),
+            'slowest': sorted(recent, key=lambda r: -r['elapsed'])[:slowest],
+            'since': self.started_at
+        }
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.recent.clear()
+            self.started_at = time.time()
+
+def _sampled():
+    return g.get('perf') if has_request_context() else None
+
+def _count_db_call(table_name, method, elapsed, scanned, returned):
+    perf = _sampled()
+    if perf is not None:
+        perf['db_calls'] += 1
+        perf['db_time'] += elapsed
+
+def _template_starting(sender, template, context, **extra):
+    perf = _sampled()
+    if perf is not None:
+        perf['render_starts'].append(time.perf_counter())
+
+def _template_done(sender, template, context, **extra):
+    perf = _sampled()
+    if perf is not None and perf['render_starts']:
+        perf['render_time'] += time.perf_counter() - perf['render_starts'].pop()
+
+def init_app(app):
+    app.performance = PerformanceMonitor()
+    app.db.call_hooks.append(_count_db_call)
+    before_render_template.connect(_template_starting, app)
+    template_rendered.connect(_template_done, app)
+
+    @app.before_request
+    def start_timer():
+        if random.random() < current_app.config.get('PERF_SAMPLE_RATE', 0.05):
+            g.perf = {'start': time.perf_counter(), 'db_calls': 0, 'db_time': 0.0,
+                      'render_time': 0.0, 'render_starts': []}
+
+    @app.after_request
+    def record_timing(response):
+        perf = g.pop('perf', None)
+        if perf is not None and request.endpoint != 'static':
+            current_app.performance.record(
+                request.endpoint or 'unmatched', request.method, request.path, response.status_code,
+                time.perf_counter() - perf['start'], perf['db_calls'], perf['db_time'],
+                perf['render_time'], response.content_length or 0)
+        return response
@@ -0,0 +1,70 @@
+import json
+from data_manager import TableCache
+
+def parse_setting(setting):
+    """Convert a Platform_Settings row's string value according to its setting_type"""
+    value = setting.get('setting_value')
+    setting_type = setting.get('setting_type', 'text')
+    if value is None:
+        return None
+
+    if setting_type == 'number':
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        return int(number) if number.is_integer() else number
+
+    if setting_type == 'json':
+        try:
+            return json.loads(value)
+        except (TypeError, ValueError):
+            # Admins edit this as free text; accept a plain comma separated list too
+            items = (v.strip().strip('"\'[]').strip() for v in str(value).split(','))
+            return [v for v in items if v]
+
+    if setting_type == 'bool':
+        return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+    return value
+
+class PlatformSettings(TableCache):
+    """Typed, in-memory view of the Platform_Settings table.
+
+    Values are parsed once by setting_type; edits through the DataManager
+    (admin.edit_setting) replace the cached value straight away.
+    """
+    tables = ('Platform_Settings',)
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._values = {}
+
+    def get(self, key, default=None):
+        self.ensure_fresh()
+        with self.lock:
+            value = self._values.get(key)
+        return default if value is None else value
+
+    def payment_method_choices(self):
+        """(value, label) pairs for the booking form's payment method field; [] keeps the form's defaults"""
+        methods = self.get('payment_methods', [])
+        if isinstance(methods, str):
+            methods = [methods]
+        if not isinstance(methods, list):
+            # A number or object saved as JSON is not a list of methods
+            return []
+        methods = [str(m).strip() for m in methods if isinstance(m, (str, int, float)) and str(m).strip()]
+        return [(m.lower().replace(' ', '_'), m) for m in methods]
+
+    def _rebuild(self):
+        self._values = {s['setting_key']: parse_setting(s) for s in self.db.get_all('Platform_Settings') if 'setting_key' in s}
+
+    def _apply(self, table_name, action, item, previous):
+        if previous and previous.get('setting_key') != item.get('setting_key'):
+            self._values.pop(previous.get('setting_key'), None)
+        if action == 'delete':
+            self._values.pop(item.get('setting_key'), None)
+        elif 'setting_key' in item:
+            self._values[item['setting_key']] = parse_setting(item)
+        return True
@@ -0,0 +1,61 @@
+from data_manager import TableCache
+
+class PlatformStats(TableCache):
+    """Headline numbers for the public landing page.
+
+    Kept as running counters so an anonymous visit costs a version check
+    instead of parsing Users, Reviews and Bookings.
+    """
+    tables = ('Users', 'Reviews', 'Bookings')
+
+    def __init__(self, db, ttl=None):
+        super().__init__(db)
+        self.ttl = ttl
+        self._active_users = 0
+        self._review_count = 0
+        self._rating_sum = 0
+        self._completed_bookings = 0
+
+    def summary(self):
+        self.ensure_fresh()
+        with self.lock:
+            average = self._rating_sum / self._review_count if self._review_count else 0
+            return {
+                'total_users': self._active_users,
+                'total_reviews': self._review_count,
+                'average_rating': round(average, 1),
+                'total_bookings': self._completed_bookings
+            }
+
+    def _rebuild(self):
+        reviews = self.db.get_all('Reviews')
+        self._active_users = sum(self._is_active(u) for u in self.db.get_all('Users'))
+        self._review_count = len(reviews)
+        self._rating_sum = sum(r.get('rating', 0) for r in reviews)
+        self._completed_bookings = sum(self._is_completed(b) for b in self.db.get_all('Bookings'))
+
+    def _apply(self, table_name, action, item, previous):
+        sign = -1 if action == 'delete' else 1
+        if table_name == 'Users':
+            if previous is not None:
+                self._active_users -= self._is_active(previous)
+            self._active_users += sign * self._is_active(item)
+        elif table_name == 'Reviews':
+            if previous is not None:
+                self._rating_sum -= previous.get('rating', 0)
+            else:
+                self._review_count += sign
+            self._rating_sum += sign * item.get('rating', 0)
+        elif table_name == 'Bookings':
+            if previous is not None:
+                self._completed_bookings -= self._is_completed(previous)
+            self._completed_bookings += sign * self._is_completed(item)
+        return True
+
+    @staticmethod
+    def _is_active(user):
+        return user.get('status') == 'active'
+
+    @staticmethod
+    def _is_completed(booking):
+        return booking.get('booking_status') == 'completed'
@@ -0,0 +1,171 @@
+"""Popularity score per service, kept in ranked order.
+
+score = BOOKING_WEIGHT * open bookings + COMPLETION_WEIGHT * completed
+bookings + RATING_WEIGHT * Bayesian rating. The rating is pulled towards
+PRIOR_RATING as if every service had PRIOR_REVIEWS extra reviews of that
+value, so one five-star review does not beat fifty four-star ones. The
+prior is a constant rather than the platform average so a new review only
+moves the score of its own service.
+
+Scores live in a list of (-score, service_id) kept sorted with bisect:
+the top N is a slice and a write moves one entry.
+"""
+import bisect
+
+from data_manager import TableCache
+
+BOOKING_WEIGHT = 1.0
+COMPLETION_WEIGHT = 2.0
+RATING_WEIGHT = 2.0
+PRIOR_RATING = 3.0
+PRIOR_REVIEWS = 5
+
+# Bookings that never happened don't make a service popular
+UNCOUNTED_STATUSES = ('cancelled', 'rejected')
+
+def bayesian_rating(rating_sum, rating_count):
+    return (PRIOR_RATING * PRIOR_REVIEWS + rating_sum) / (PRIOR_REVIEWS + rating_count)
+
+class ServicePopularity(TableCache):
+    tables = ('Services', 'Bookings', 'Reviews')
+
+    def __init__(self, db, ratings):
+        super().__init__(db)
+        self.ratings = ratings
+        self._bookings = {}
+        self._completions = {}
+        self._all_bookings = {}
+        self._service_category = {}
+        self._category_bookings = {}
+        self._scores = {}
+        self._ranking = []
+
+    def score(self, service_id):
+        self.ensure_fresh()
+        with self.lock:
+            return self._scores.get(service_id, 0.0)
+
+    def scores(self):
+        """{service_id: score} for every service (a copy)"""
+        self.ensure_fresh()
+        with self.lock:
+            return dict(self._scores)
+
+    def top(self, limit, ids=None):
+        """Up to limit service ids, most popular first (ties by id), optionally only those in ids"""
+        self.ensure_fresh()
+        with self.lock:
+            if ids is None:
+                return [service_id for negative_score, service_id in self._ranking[:limit]]
+            return self._ranked(ids)[:limit]
+
+    def ranked(self, ids):
+        """ids ordered most popular first (ties by id)"""
+        self.ensure_fresh()
+        with self.lock:
+            return self._ranked(ids)
+
+    def ranked_scores(self, ids):
+        """(ids ordered most popular first, {service_id: score} for them), read under one lock"""
+        self.ensure_fresh()
+        with self.lock:
+            ranked = self._ranked(ids)
+            return ranked, {service_id: self._scores[service_id] for service_id in ranked}
+
+    def category_bookings(self):
+        """{category_id: number of bookings of its services}"""
+        self.ensure_fresh()
+        with self.lock:
+            return dict(self._category_bookings)
+
+    def _ranked(self, ids):
+        if not isinstance(ids, (set, frozenset, dict)):
+            ids = set(ids)
+        if len(ids) * 8 < len(self._ranking):
+            # A small selection: sorting it beats walking the whole ranking
+            return sorted((service_id for service_id in ids if service_id in self._scores),
+                          key=lambda service_id: (-self._scores[service_id], service_id))
+        return [service_id for negative_score, service_id in self._ranking if service_id in ids]
+
+    def _rebuild(self):
+        self._bookings = {}
+        self._completions = {}
+        self._all_bookings = {}
+        self._service_category = {}
+        self._category_bookings = {}
+        self._scores = {}
+        for booking in self.db.get_all('Bookings'):
+            self._count_booking(booking, 1)
+        ratings = self.ratings.all_services()
+        for service in self.db.get_all('Services'):
+            self._put_service(service)
+            self._scores[service['id']] = self._score(service['id'], ratings.get(service['id']))
+        self._ranking = sorted((-score, service_id) for service_id, score in self._scores.items())
+
+    def _apply(self, table_name, action, item, previous):
+        if table_name == 'Services':
+            self._drop_service(item['id'])
+            self._unrank(item['id'])
+            if action != 'delete':
+                self._put_service(item)
+                self._rank(item['id'])
+        elif table_name == 'Bookings':
+            if previous is not None:
+                self._count_booking(previous, -1)
+            self._count_booking(item, -1 if action == 'delete' else 1)
+            for service_id in {row.get('service_id') for row in (item, previous) if row}:
+                self._rerank(service_id)
+        elif table_name == 'Reviews':
+            service_ids = {row.get('service_id') for row in (item, previous) if row}
+            if None in service_ids:
+                # Older reviews only reach their service through the booking
+                return False
+            for service_id in service_ids:
+                self._rerank(service_id)
+        return True
+
+    def _count_booking(self, booking, sign):
+        service_id = booking.get('service_id')
+        self._all_bookings[service_id] = self._all_bookings.get(service_id, 0) + sign
+        if service_id in self._service_category:
+            category_id = self._service_category[service_id]
+            self._category_bookings[category_id] = self._category_bookings.get(category_id, 0) + sign
+        status = booking.get('booking_status')
+        if status not in UNCOUNTED_STATUSES:
+            self._bookings[service_id] = self._bookings.get(service_id, 0) + sign
+        if status == 'completed':
+            self._completions[service_id] = self._completions.get(service_id, 0) + sign
+
+    def _put_service(self, service):
+        category_id = service.get('category_id')
+        self._service_category[service['id']] = category_id
+        self._category_bookings[category_id] = (self._category_bookings.get(category_id, 0)
+                                                + self._all_bookings.get(service['id'], 0))
+
+    def _drop_service(self, service_id):
+        if service_id in self._service_category:
+            category_id = self._service_category.pop(service_id)
+            self._category_bookings[category_id] -= self._all_bookings.get(service_id, 0)
+
+    def _score(self, service_id, rating):
+        bayesian = bayesian_rating(rating['sum'], rating['count']) if rating else PRIOR_RATING
+        return (BOOKING_WEIGHT * self._bookings.get(service_id, 0)
+                + COMPLETION_WEIGHT * self._completions.get(service_id, 0)
+                + RATING_WEIGHT * bayesian)
+
+    def _rerank(self, service_id):
+        if service_id in self._scores:
+            self._unrank(service_id)
+            self._rank(service_id)
+
+    def _rank(self, service_id):
+        score = self._scores[service_id] = self._score(service_id, self.ratings.for_service(service_id))
+        bisect.insort(self._ranking, (-score, service_id))
+
+    def _unrank(self, service_id):
+        score = self._scores.pop(service_id, None)
+        if score is None:
+            return
+        index = bisect.bisect_left(self._ranking, (-score, service_id))
+        if index < len(self._ranking) and self._ranking[index] == (-score, service_id):
+            self._ranking.pop(index)
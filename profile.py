@@ -42,12 +42,10 @@ def view():
         all_services = current_app.db.get_all("Services")
         my_services = [s for s in all_services if s["provider_id"] == user["id"]]
         provider_bookings = [b for b in all_bookings if b["provider_id"] == user["id"]]
-        all_reviews = current_app.db.get_all("Reviews")
-        my_reviews = [r for r in all_reviews if r["provider_id"] == user["id"]]
 
         total_services = len(my_services)
         total_bookings = len(provider_bookings)
-        average_rating = sum([r["rating"] for r in my_reviews]) / len(my_reviews) if my_reviews else 0
+        average_rating = current_app.ratings.for_provider(user["id"])["average"]
         total_earnings = sum([current_app.db.get_by_id("Services", b["service_id"])["price"] for b in provider_bookings if b["booking_status"] == "completed" and current_app.db.get_by_id("Services", b["service_id"])]) if provider_bookings else 0
 
         provider_stats = {
@@ -96,12 +94,10 @@ def view_other(user_id):
         all_services = current_app.db.get_all("Services")
         my_services = [s for s in all_services if s["provider_id"] == user_id]
         provider_bookings = [b for b in all_bookings if b["provider_id"] == user_id]
-        all_reviews = current_app.db.get_all("Reviews")
-        my_reviews = [r for r in all_reviews if r["provider_id"] == user_id]
 
         total_services = len(my_services)
         total_bookings = len(provider_bookings)
-        average_rating = sum([r["rating"] for r in my_reviews]) / len(my_reviews) if my_reviews else 0
+        average_rating = current_app.ratings.for_provider(user_id)["average"]
         total_earnings = sum([current_app.db.get_by_id("Services", b["service_id"])["price"] for b in provider_bookings if b["booking_status"] == "completed" and current_app.db.get_by_id("Services", b["service_id"])]) if provider_bookings else 0
 
         provider_stats = {
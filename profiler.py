@@ -0,0 +1,231 @@
+"""On-demand cProfile capture of a single request.
+
+An admin (or a client sending the PROFILE_TOKEN) adds ``?_profile=1`` or an
+``X-Profile: 1`` header to a request and that one request runs under
+cProfile. Each capture is written to PROFILE_DIR as:
+
+    <name>.pstats   loadable with pstats / snakeviz
+    <name>.folded   collapsed stacks ("a;b;c <microseconds>") for
+                    flamegraph.pl, speedscope or inferno
+    <name>.json     request details and the top functions, for the admin list
+
+Only the newest PROFILE_KEEP captures are kept. Requests without the flag only pay for the flag lookup.
+"""
+import hmac
+import json
+import marshal
+import os
+import pstats
+import re
+import threading
+import time
+from datetime import datetime
+
+import _lsprof
+from flask import current_app, g, request
+
+PROFILE_FLAG = '_profile'
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+
+# Stacks deeper than this are cut at the top when collapsing
+MAX_STACK_DEPTH = 128
+
+# Files making up a capture
+CAPTURE_EXTENSIONS = ('.pstats', '.folded', '.json')
+
+# cProfile can only have one active profiler at a time on newer Pythons
+_active = threading.Lock()
+
+def _code_label(code):
+    if isinstance(code, str):
+        return ('~', 0, code)
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+class RequestProfile(_lsprof.Profiler):
+    """cProfile.Profile without the import: our profile blueprint shadows the
+    stdlib ``profile`` module that cProfile imports. Produces the same stats
+    dict, so pstats.Stats(RequestProfile) and the .pstats files work as usual.
+    """
+
+    def create_stats(self):
+        self.disable()
+        entries = self.getstats()
+        self.stats = {}
+        callers_by_code = {}
+        for entry in entries:
+            callers = callers_by_code[id(entry.code)] = {}
+            self.stats[_code_label(entry.code)] = (entry.callcount - entry.reccallcount, entry.callcount,
+                                                   entry.inlinetime, entry.totaltime, callers)
+        for entry in entries:
+            func = _code_label(entry.code)
+            for sub in entry.calls or ():
+                callers = callers_by_code.get(id(sub.code))
+                if callers is None:
+                    continue
+                edge = (sub.callcount, sub.callcount - sub.reccallcount, sub.inlinetime, sub.totaltime)
+                if func in callers:
+                    edge = tuple(a + b for a, b in zip(edge, callers[func]))
+                callers[func] = edge
+
+    def dump_stats(self, path):
+        self.create_stats()
+        with open(path, 'wb') as f:
+            marshal.dump(self.stats, f)
+
+def _requested():
+    return request.args.get(PROFILE_FLAG) == '1' or request.headers.get(PROFILE_HEADER) == '1'
+
+def _authorized():
+    token = current_app.config.get('PROFILE_TOKEN')
+    supplied = request.headers.get(PROFILE_TOKEN_HEADER)
+    if token and supplied and hmac.compare_digest(token, supplied):
+        return True
+    return bool(g.get('user')) and g.user.get('role') == 'admin'
+
+def _label(func):
+    filename, lineno, name = func
+    if filename == '~':
+        # Built-ins, e.g. "<built-in method builtins.len>"
+        label = name
+    else:
+        label = f'{name} ({os.path.basename(filename)}:{lineno})'
+    # flamegraph tools split frames on ';' and the count on the last space
+    return label.replace(';', ':')
+
+def collapse_stats(stats):
+    """Collapsed stacks built from the pstats caller graph.
+
+    cProfile only keeps caller -> callee edges, not whole stacks, so the
+    own time of each function is spread over the paths leading to it in
+    proportion to the cumulative time of each incoming edge. Returns
+    {"root;...;leaf": microseconds}.
+    """
+    stacks = {}
+
+    def walk(func, own_time, path):
+        callers = stats[func][4]
+        edges = [(caller, edge[3]) for caller, edge in callers.items()
+                 if caller in stats and caller not in path]
+        edge_total = sum(ct for caller, ct in edges)
+        if not edges or edge_total <= 0 or len(path) >= MAX_STACK_DEPTH:
+            key = ';'.join(_label(f) for f in reversed(path))
+            stacks[key] = stacks.get(key, 0) + own_time
+            return
+        for caller, ct in edges:
+            share = own_time * ct / edge_total
+            if share >= 1e-6:
+                walk(caller, share, path + [caller])
+
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        if tt > 0:
+            walk(func, tt, [func])
+    return {key: int(round(seconds * 1e6)) for key, seconds in stacks.items() if seconds >= 5e-7}
+
+def _top_functions(stats, limit=15):
+    rows = sorted(stats.items(), key=lambda item: -item[1][3])[:limit]
+    return [{
+        'function': _label(func),
+        'calls': nc,
+        'own_time': round(tt, 6),
+        'cumulative_time': round(ct, 6)
+    } for func, (cc, nc, tt, ct, callers) in rows]
+
+def _capture_name(endpoint):
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    return f"{stamp}-{re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint)}"
+
+def save_capture(profile_dir, profile, details, keep=None):
+    """Write the .pstats, .folded and .json files of one capture; returns its name.
+
+    With keep set, older captures beyond the newest keep are deleted.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    name = _capture_name(details['endpoint'])
+    base = os.path.join(profile_dir, name)
+
+    profile.dump_stats(base + '.pstats')
+    stats = pstats.Stats(profile).stats
+    with open(base + '.folded', 'w') as f:
+        for stack, micros in sorted(collapse_stats(stats).items()):
+            if micros:
+                f.write(f'{stack} {micros}\n')
+    with open(base + '.json', 'w') as f:
+        json.dump(dict(details, name=name, top_functions=_top_functions(stats)), f, indent=4)
+    if keep is not None:
+        prune_captures(profile_dir, keep)
+    return name
+
+def prune_captures(profile_dir, keep):
+    """Delete all but the newest keep captures (names start with their timestamp)"""
+    filenames = [f for f in os.listdir(profile_dir) if f.endswith(CAPTURE_EXTENSIONS)]
+    names = sorted({os.path.splitext(f)[0] for f in filenames}, reverse=True)
+    expired = set(names[max(keep, 0):])
+    for filename in filenames:
+        if os.path.splitext(filename)[0] in expired:
+            try:
+                os.remove(os.path.join(profile_dir, filename))
+            except FileNotFoundError:
+                # Another worker pruned it first
+                pass
+
+def list_captures(profile_dir):
+    """Details of the saved captures, newest first"""
+    if not os.path.isdir(profile_dir):
+        return []
+    captures = []
+    for filename in sorted(os.listdir(profile_dir), reverse=True):
+        if filename.endswith('.json'):
+            try:
+                with open(os.path.join(profile_dir, filename)) as f:
+                    captures.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return captures
+
+def _finish(status):
+    capture = g.pop('profile_capture', None)
+    if capture is None:
+        return None
+    profile, started = capture
+    profile.disable()
+    try:
+        return save_capture(current_app.config['PROFILE_DIR'], profile, {
+            'endpoint': request.endpoint or 'unmatched',
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': status,
+            'elapsed': round(time.perf_counter() - started, 6),
+            'user_id': g.user['id'] if g.get('user') else None,
+            'created_at': datetime.now().isoformat()
+        }, keep=current_app.config.get('PROFILE_KEEP'))
+    finally:
+        _active.release()
+
+def init_app(app):
+    """Register the profiling hooks; call after the auth blueprint so g.user is loaded"""
+
+    @app.before_request
+    def start_profile():
+        if not _requested() or not _authorized():
+            return
+        if not _active.acquire(blocking=False):
+            current_app.logger.warning('Profile of %s skipped: another capture is running', request.path)
+            return
+        profile = RequestProfile()
+        g.profile_capture = (profile, time.perf_counter())
+        profile.enable()
+
+    @app.after_request
+    def stop_profile(response):
+        name = _finish(response.status_code)
+        if name:
+            response.headers['X-Profile-Capture'] = name
+            current_app.logger.info('Saved profile %s', name)
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exc):
+        # after_request doesn't run when the view raised
+        if 'profile_capture' in g:
+            _finish(500)
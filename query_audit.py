@@ -0,0 +1,97 @@
+"""Development-mode audit of DataManager calls per request.
+
+Every table access made while handling a request is recorded together with
+the line of application code that made it. After the request we warn about
+N+1 patterns (the same lookup on the same table repeated from one call
+site, i.e. inside a loop) and about routes that go over their call budget.
+With DB_CALL_BUDGET_STRICT set, going over budget raises instead, which
+makes the offending test fail.
+"""
+import os
+import sys
+from flask import current_app, g, has_request_context, request
+
+# Per-row lookup methods; repeating these from one line is the N+1 smell
+LOOKUP_METHODS = ('get_by_id', 'find_by_attribute')
+
+# Frames from these modules are skipped when finding the calling line
+_INTERNAL_FILES = ('data_manager.py', 'query_audit.py', 'identity_map.py')
+
+class DBCallBudgetExceeded(Exception):
+    pass
+
+class QueryAudit:
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.calls = []
+
+    def record(self, table_name, method, elapsed, scanned, returned):
+        self.calls.append((table_name, method, self._call_site(), elapsed))
+
+    def _call_site(self):
+        frame = sys._getframe(2)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename.startswith(self.root_path) and os.path.basename(filename) not in _INTERNAL_FILES:
+                return f'{os.path.relpath(filename, self.root_path)}:{frame.f_lineno} in {frame.f_code.co_name}'
+            frame = frame.f_back
+        return 'unknown'
+
+    def grouped(self):
+        """{(table, method, call_site): count}"""
+        groups = {}
+        for table_name, method, call_site, elapsed in self.calls:
+            key = (table_name, method, call_site)
+            groups[key] = groups.get(key, 0) + 1
+        return groups
+
+    def repeated_lookups(self, threshold):
+        return {key: count for key, count in self.grouped().items()
+                if key[1] in LOOKUP_METHODS and count >= threshold}
+
+def _enabled(app):
+    enabled = app.config.get('DB_AUDIT_ENABLED')
+    return app.debug if enabled is None else enabled
+
+def _record(table_name, method, elapsed, scanned, returned):
+    if has_request_context():
+        audit = g.get('db_audit')
+        if audit is not None:
+            audit.record(table_name, method, elapsed, scanned, returned)
+
+def call_budget(app, endpoint):
+    return app.config.get('DB_CALL_BUDGETS', {}).get(endpoint, app.config.get('DB_CALL_BUDGET'))
+
+def init_app(app):
+    app.db.call_hooks.append(_record)
+
+    @app.before_request
+    def start_audit():
+        if _enabled(current_app):
+            g.db_audit = QueryAudit(current_app.root_path)
+
+    @app.after_request
+    def check_audit(response):
+        audit = g.pop('db_audit', None)
+        if audit is None:
+            return response
+
+        endpoint = request.endpoint or request.path
+        total = len(audit.calls)
+        response.headers['X-DB-Calls'] = str(total)
+
+        threshold = current_app.config.get('DB_AUDIT_NPLUSONE_THRESHOLD', 3)
+        for (table_name, method, call_site), count in audit.repeated_lookups(threshold).items():
+            current_app.logger.warning('Possible N+1 in %s: %s(%r) called %d times from %s',
+                                       endpoint, method, table_name, count, call_site)
+
+        budget = call_budget(current_app, endpoint)
+        if budget is not None and total > budget:
+            summary = ', '.join(f'{table_name}.{method} x{count} at {call_site}'
+                                for (table_name, method, call_site), count
+                                in sorted(audit.grouped().items(), key=lambda item: -item[1]))
+            message = f'{endpoint} made {total} DataManager calls (budget {budget}): {summary}'
+            if current_app.config.get('DB_CALL_BUDGET_STRICT'):
+                raise DBCallBudgetExceeded(message)
+            current_app.logger.warning(message)
+        return response
@@ -0,0 +1,93 @@
+from data_manager import TableCache
+
+RATING_VALUES = (1, 2, 3, 4, 5)
+
+def empty_summary():
+    return {'sum': 0, 'count': 0, 'average': 0, 'histogram': {value: 0 for value in RATING_VALUES}}
+
+class RatingAggregates(TableCache):
+    """Running rating totals (sum, count, histogram) per provider and per service.
+
+    Flagged reviews are left out, the same as on the service detail page, so
+    flagging or unflagging a review moves it out of or back into the totals.
+    """
+    tables = ('Reviews',)
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._providers = {}
+        self._services = {}
+        self._review_services = {}
+
+    def for_provider(self, provider_id):
+        self.ensure_fresh()
+        with self.lock:
+            return self._summary(self._providers.get(provider_id))
+
+    def for_service(self, service_id):
+        self.ensure_fresh()
+        with self.lock:
+            return self._summary(self._services.get(service_id))
+
+    def all_services(self):
+        """{service_id: summary} for every service with reviews"""
+        self.ensure_fresh()
+        with self.lock:
+            return {service_id: self._summary(totals) for service_id, totals in self._services.items()}
+
+    def _summary(self, totals):
+        summary = empty_summary()
+        if totals:
+            summary['sum'] = totals['sum']
+            summary['count'] = totals['count']
+            summary['average'] = totals['sum'] / totals['count'] if totals['count'] else 0
+            summary['histogram'] = dict(totals['histogram'])
+        return summary
+
+    def _rebuild(self):
+        reviews = self.db.get_all('Reviews')
+        booking_services = {}
+        if any('service_id' not in r for r in reviews):
+            booking_services = {b.get('id'): b.get('service_id') for b in self.db.get_all('Bookings')}
+
+        self._providers = {}
+        self._services = {}
+        self._review_services = {}
+        for review in reviews:
+            service_id = review.get('service_id', booking_services.get(review.get('booking_id')))
+            self._review_services[review.get('id')] = service_id
+            self._count(review, service_id, 1)
+
+    def _apply(self, table_name, action, item, previous):
+        if action == 'add':
+            service_id = item.get('service_id')
+            if service_id is None:
+                booking = self.db.get_by_id('Bookings', item.get('booking_id'))
+                service_id = booking.get('service_id') if booking else None
+            self._review_services[item.get('id')] = service_id
+            self._count(item, service_id, 1)
+        elif action == 'update':
+            service_id = self._review_services.get(item.get('id'))
+            self._count(previous, service_id, -1)
+            self._count(item, service_id, 1)
+        elif action == 'delete':
+            service_id = self._review_services.pop(item.get('id'), None)
+            self._count(item, service_id, -1)
+        return True
+
+    def _count(self, review, service_id, sign):
+        """Add (sign=1) or remove (sign=-1) one review from the totals"""
+        if review.get('is_flagged', False):
+            return
+        rating = review.get('rating', 0)
+        keyed = [(self._providers, review.get('provider_id'))]
+        if service_id is not None:
+            keyed.append((self._services, service_id))
+        for store, key in keyed:
+            totals = store.setdefault(key, {'sum': 0, 'count': 0, 'histogram': {value: 0 for value in RATING_VALUES}})
+            totals['sum'] += sign * rating
+            totals['count'] += sign
+            if rating in totals['histogram']:
+                totals['histogram'][rating] += sign
+            if totals['count'] <= 0:
+                del store[key]
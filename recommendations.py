@@ -0,0 +1,124 @@
+"""Precomputed service recommendations for the user dashboard.
+
+TopRatedServices keeps every recommendable service (approved, from an
+active provider, average rating above MIN_RATING) in rankings sorted with
+bisect, one over all services and one per category. Services are ordered
+by their Bayesian rating, so a single five-star review does not outrank a
+long record of good ones. A write to a service, provider or review moves
+only the services it touches, and the dashboard takes a short slice.
+"""
+import bisect
+
+from catalog import is_public
+from data_manager import TableCache
+from popularity import bayesian_rating
+
+# Services need an average above this to be recommended at all
+MIN_RATING = 4.5
+
+# Recommendations shown on the user dashboard
+DASHBOARD_RECOMMENDATIONS = 4
+# Of those, at most this many come from the user's booking history (collaborative.py)
+PERSONAL_RECOMMENDATIONS = 3
+
+def _rank_key(listing):
+    count = listing['review_count']
+    return (-bayesian_rating(listing['avg_rating'] * count, count), -count, listing['id'])
+
+class TopRatedServices(TableCache):
+    tables = ('Services', 'Users', 'Reviews')
+
+    def __init__(self, db, catalog):
+        super().__init__(db)
+        self.catalog = catalog
+        self._overall = []
+        self._by_category = {}
+        self._ranked = {}
+
+    def top(self, limit, category_id=None, exclude=()):
+        """Ids of the best rated services (in category_id if given), skipping those in exclude"""
+        if limit <= 0:
+            return []
+        self.ensure_fresh()
+        with self.lock:
+            ranking = self._overall if category_id is None else self._by_category.get(category_id, [])
+            result = []
+            for key in ranking:
+                if key[-1] not in exclude:
+                    result.append(key[-1])
+                    if len(result) == limit:
+                        break
+            return result
+
+    def for_user(self, booked_services, limit=DASHBOARD_RECOMMENDATIONS, personal=()):
+        """Ids to recommend to someone who booked booked_services ({id: service row}).
+
+        Up to PERSONAL_RECOMMENDATIONS of personal (ids picked from their
+        booking history) that are still on offer come first. The best rated
+        services in the category they book most follow, topped up from all
+        categories; services they booked are left out.
+        """
+        booked = set(booked_services)
+        recommended = []
+        for service_id in personal:
+            if len(recommended) >= min(limit, PERSONAL_RECOMMENDATIONS):
+                break
+            listing = self.catalog.get(service_id)
+            if service_id not in booked and listing is not None and is_public(listing):
+                recommended.append(service_id)
+        category_counts = {}
+        for service in booked_services.values():
+            category_counts[service.get('category_id')] = category_counts.get(service.get('category_id'), 0) + 1
+        if category_counts:
+            favourite = max(category_counts, key=category_counts.get)
+            recommended += self.top(limit - len(recommended), category_id=favourite, exclude=booked | set(recommended))
+        return recommended + self.top(limit - len(recommended), exclude=booked | set(recommended))
+
+    def _rebuild(self):
+        self._overall = []
+        self._by_category = {}
+        self._ranked = {}
+        for listing in self.catalog.visible_to(None):
+            self._rank(listing, keep_sorted=False)
+        self._overall.sort()
+        for ranking in self._by_category.values():
+            ranking.sort()
+
+    def _apply(self, table_name, action, item, previous):
+        if table_name == 'Services':
+            service_ids = {item['id']}
+        elif table_name == 'Users':
+            service_ids = {listing['id'] for listing in self.catalog.for_provider(item['id'])}
+        else:
+            service_ids = {row.get('service_id') for row in (item, previous) if row}
+            if None in service_ids:
+                # Older reviews only reach their service through the booking
+                return False
+        for service_id in service_ids:
+            self._unrank(service_id)
+            listing = self.catalog.get(service_id)
+            if listing is not None:
+                self._rank(listing)
+        return True
+
+    def _rank(self, listing, keep_sorted=True):
+        if not is_public(listing) or listing['avg_rating'] <= MIN_RATING:
+            return
+        key = _rank_key(listing)
+        category_id = listing.get('category_id')
+        self._ranked[listing['id']] = (key, category_id)
+        for ranking in (self._overall, self._by_category.setdefault(category_id, [])):
+            if keep_sorted:
+                bisect.insort(ranking, key)
+            else:
+                ranking.append(key)
+
+    def _unrank(self, service_id):
+        ranked = self._ranked.pop(service_id, None)
+        if ranked is None:
+            return
+        key, category_id = ranked
+        for ranking in (self._overall, self._by_category.get(category_id, [])):
+            index = bisect.bisect_left(ranking, key)
+            if index < len(ranking) and ranking[index] == key:
+                ranking.pop(index)
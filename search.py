@@ -0,0 +1,140 @@
+"""Full-text search over Services.
+
+Service names, descriptions and locations are tokenised into an inverted
+index (term -> {service_id: weighted term frequency}); the name counts
+more than the other fields. Every query word must match a term, either
+exactly or as a prefix ("clean" finds "cleaning"), and results are ranked
+with BM25. Prefixes are looked up with bisect over the sorted term list,
+so a query touches only the postings of the terms it matches.
+"""
+import bisect
+import math
+import re
+import unicodedata
+
+from data_manager import TableCache
+
+FIELD_WEIGHTS = {'service_name': 3, 'description': 1, 'location': 1}
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Score multiplier for a word that only matched as a prefix
+PREFIX_MATCH_WEIGHT = 0.5
+
+_WORD = re.compile(r'\w+')
+
+def tokenize(text):
+    """Lower-cased, accent-stripped words of text"""
+    if not text:
+        return []
+    text = str(text).lower()
+    if not text.isascii():
+        text = ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    return _WORD.findall(text)
+
+class ServiceSearchIndex(TableCache):
+    tables = ('Services',)
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._postings = {}
+        self._terms = []
+        self._docs = {}
+        self._total_length = 0
+
+    def search(self, query):
+        """{service_id: score} of the services matching every word of query"""
+        words = tokenize(query)
+        if not words:
+            return {}
+        self.ensure_fresh()
+        with self.lock:
+            # Most selective word first, so later words only score its matches
+            matches = sorted((self._matching_terms(word) for word in dict.fromkeys(words)),
+                             key=lambda match: sum(len(self._postings[term]) for term in match[0]))
+            scores = None
+            for terms, word in matches:
+                word_scores = self._score_terms(word, terms, scores)
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {doc_id: score + word_scores[doc_id] for doc_id, score in scores.items()
+                              if doc_id in word_scores}
+                if not scores:
+                    return {}
+            return scores
+
+    def _matching_terms(self, word):
+        """(terms starting with word, word)"""
+        start = bisect.bisect_left(self._terms, word)
+        end = start
+        while end < len(self._terms) and self._terms[end].startswith(word):
+            end += 1
+        return self._terms[start:end], word
+
+    def _score_terms(self, word, terms, candidates=None):
+        """Best BM25 score per service over the terms word matched, limited to candidates if given"""
+        doc_count = len(self._docs)
+        average_length = self._total_length / doc_count if doc_count else 1
+        scores = {}
+        for term in terms:
+            postings = self._postings[term]
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            weight = idf if term == word else idf * PREFIX_MATCH_WEIGHT
+            if candidates is not None and len(candidates) < len(postings):
+                hits = ((doc_id, postings[doc_id]) for doc_id in candidates if doc_id in postings)
+            else:
+                hits = postings.items()
+            for doc_id, tf in hits:
+                length = self._docs[doc_id][1]
+                score = weight * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / average_length))
+                if score > scores.get(doc_id, 0):
+                    scores[doc_id] = score
+        return scores
+
+    def _rebuild(self):
+        self._postings = {}
+        self._docs = {}
+        self._total_length = 0
+        for service in self.db.get_all('Services'):
+            self._add(service)
+        self._terms = sorted(self._postings)
+
+    def _apply(self, table_name, action, item, previous):
+        self._remove(item.get('id'))
+        if action != 'delete':
+            self._add(item, keep_terms_sorted=True)
+        return True
+
+    def _add(self, service, keep_terms_sorted=False):
+        frequencies = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(service.get(field)):
+                frequencies[term] = frequencies.get(term, 0) + weight
+        length = sum(frequencies.values())
+        self._docs[service.get('id')] = (frequencies, length)
+        self._total_length += length
+        for term, tf in frequencies.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                if keep_terms_sorted:
+                    bisect.insort(self._terms, term)
+            postings[service.get('id')] = tf
+
+    def _remove(self, service_id):
+        doc = self._docs.pop(service_id, None)
+        if doc is None:
+            return
+        frequencies, length = doc
+        self._total_length -= length
+        for term in frequencies:
+            postings = self._postings[term]
+            postings.pop(service_id, None)
+            if not postings:
+                del self._postings[term]
+                index = bisect.bisect_left(self._terms, term)
+                if index < len(self._terms) and self._terms[index] == term:
+                    self._terms.pop(index)
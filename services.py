@@ -1,97 +1,114 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, g, current_app, jsonify
 from forms import ServiceForm
 from auth import login_required
+from pagination import paginate
+from catalog import PRICE_BANDS
+from view_counter import record_view
 import random
 import string
 
 bp = Blueprint('services', __name__, url_prefix='/services')
 
+# Services per page in browse, and the most a client may ask for with ?limit=
+BROWSE_PAGE_SIZE = 12
+BROWSE_MAX_PAGE_SIZE = 60
+
+# Location words offered as filter shortcuts, most common first
+BROWSE_LOCATION_FACETS = 8
+
+# Suggestions returned by /services/autocomplete unless ?limit= asks for fewer
+AUTOCOMPLETE_LIMIT = 8
+
 def get_db():
     return current_app.db
 
+def browse_sort_key(sort_by, relevance, popularity):
+    """(key, reverse) for sorting catalog listings; keys end in the id so they are unique"""
+    if sort_by == 'relevance' and relevance:
+        return (lambda s: (relevance[s['id']], -s['id'])), True
+    if sort_by in ('popular', 'relevance'):
+        return (lambda s: (popularity.get(s['id'], 0), -s['id'])), True
+    if sort_by == 'price_low':
+        return (lambda s: (s.get('price', 0), s['id'])), False
+    if sort_by == 'price_high':
+        return (lambda s: (s.get('price', 0), s['id'])), True
+    if sort_by == 'newest':
+        return (lambda s: (s.get('created_at', ''), s['id'])), True
+    return (lambda s: (s['id'],)), False
+
 @bp.route('/')
 def browse():
     """Browse all services with optional filtering"""
-    db = get_db()
-    all_services = db.get_all('Services')
-    categories = db.get_all('Service_Categories')
-    
-    # Filter to show only active/approved services from active providers
-    # Also show provider's own pending/active services
-    services = []
-    current_user_id = g.user['id'] if g.user else None
-    
-    for service in all_services:
-        # Show service if it's approved/active OR if it belongs to the current user (show own pending services)
-        is_own_service = current_user_id and service.get('provider_id') == current_user_id
-        is_approved = service.get('status') in ['active', 'approved']
-        
-        if not (is_approved or is_own_service):
-            continue
-            
-        provider = db.get_by_id('Users', service.get('provider_id'))
-        if provider and provider.get('status') == 'active':
-            services.append(service)
+    catalog = current_app.catalog
     
     # Get filter parameters
     search_query = request.args.get('q', '').strip()
-    category_filter = request.args.get('category')
-    location_filter = request.args.get('location')
+    category_filter = request.args.get('category', type=int)
+    location_filter = request.args.get('location', '').strip()
     min_price = request.args.get('min_price', type=float)
     max_price = request.args.get('max_price', type=float)
-    sort_by = request.args.get('sort', 'popular')
+    price_band = request.args.get('price_band', type=int)
+    sort_by = request.args.get('sort', 'relevance' if search_query else 'popular')
     
-    # Apply search filter
+    # Search (every word must match a word of the name, description or location)
+    relevance = {}
     if search_query:
-        services = [s for s in services if 
-                   search_query.lower() in s.get('service_name', '').lower() or
-                   search_query.lower() in s.get('description', '').lower() or
-                   search_query.lower() in s.get('location', '').lower()]
-    
-    # Apply other filters
-    if category_filter:
-        services = [s for s in services if s.get('category_id') == int(category_filter)]
-    
-    if location_filter:
-        services = [s for s in services if location_filter.lower() in s.get('location', '').lower()]
-    
-    if min_price is not None:
-        services = [s for s in services if s.get('price', 0) >= min_price]
-    
-    if max_price is not None:
-        services = [s for s in services if s.get('price', 0) <= max_price]
-    
-    # Enrich services with category and provider information
-    for service in services:
-        category = db.get_by_id('Service_Categories', service.get('category_id'))
-        provider = db.get_by_id('Users', service.get('provider_id'))
-        service['category_name'] = category.get('category_name') if category else 'Unknown'
-        service['provider_name'] = provider.get('name') if provider else 'Unknown'
-        service['provider_email'] = provider.get('email') if provider else 'Unknown'
-        
-        # Get average rating for sorting
-        reviews = [r for r in db.get_all('Reviews') if r.get('service_id') == service['id']]
-        if reviews:
-            service['avg_rating'] = sum(r.get('rating', 0) for r in reviews) / len(reviews)
-            service['review_count'] = len(reviews)
+        relevance = current_app.search_index.search(search_query)
+    
+    # Approved services from active providers, plus the provider's own pending ones,
+    # narrowed through the catalog's category, location and price indexes, with
+    # the number of results each other filter value would give
+    price_order = {'price_low': 'asc', 'price_high': 'desc'}.get(sort_by)
+    services, facets = catalog.select_faceted(g.user['id'] if g.user else None,
+                                              ids=relevance.keys() if search_query else None,
+                                              category_id=category_filter, location=location_filter or None,
+                                              min_price=min_price, max_price=max_price,
+                                              price_band=price_band, price_order=price_order)
+    top_locations = sorted(facets['location'].items(), key=lambda item: (-item[1], item[0]))[:BROWSE_LOCATION_FACETS]
+    
+    # Every sort key ends in the id, so keyset cursors are unambiguous. The
+    # popularity order and the scores the cursors use are read together, so
+    # a concurrent booking or review can't leave them disagreeing.
+    popular = sort_by == 'popular' or (sort_by == 'relevance' and not relevance)
+    popular_ids, popularity = [], {}
+    if popular:
+        popular_ids, popularity = current_app.popularity.ranked_scores({listing['id'] for listing in services})
+    sort_key, reverse = browse_sort_key(sort_by, relevance, popularity)
+    if popular:
+        # Read the order off the popularity ranking instead of sorting
+        by_id = {listing['id']: listing for listing in services}
+        services = [by_id[service_id] for service_id in popular_ids]
+    elif price_order is None:
+        # Price sorts come back from the catalog already in order
+        services.sort(key=sort_key, reverse=reverse)
+    
+    limit = min(max(request.args.get('limit', BROWSE_PAGE_SIZE, type=int), 1), BROWSE_MAX_PAGE_SIZE)
+    page = paginate(services, sort_key, limit, page=request.args.get('page', 1, type=int),
+                    cursor=request.args.get('cursor'), reverse=reverse)
+    # Listings are shared with the catalog; the page gets its own copies
+    page.items = [dict(listing) for listing in page.items]
+    
+    return render_template('services/browse.html', services=page.items, page=page,
+                           categories=catalog.active_categories(), sort_by=sort_by,
+                           facets=facets, top_locations=top_locations, price_bands=PRICE_BANDS)
+
+@bp.route('/autocomplete')
+def autocomplete():
+    """Search box suggestions (service names, categories, locations) as JSON, most booked first"""
+    prefix = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int), 1), AUTOCOMPLETE_LIMIT)
+    
+    suggestions = []
+    for kind, label, value, bookings in current_app.autocomplete.suggest(prefix, limit):
+        if kind == 'category':
+            url = url_for('services.browse', category=value)
+        elif kind == 'location':
+            url = url_for('services.browse', location=value)
         else:
-            service['avg_rating'] = 0
-            service['review_count'] = 0
-    
-    # Apply sorting
-    if sort_by == 'popular':
-        services.sort(key=lambda s: (s.get('review_count', 0), s.get('avg_rating', 0)), reverse=True)
-    elif sort_by == 'price_low':
-        services.sort(key=lambda s: s.get('price', 0))
-    elif sort_by == 'price_high':
-        services.sort(key=lambda s: s.get('price', 0), reverse=True)
-    elif sort_by == 'newest':
-        services.sort(key=lambda s: s.get('created_at', ''), reverse=True)
-    
-    # Filter to show only active categories
-    categories = [c for c in categories if c.get('is_active', True)]
-    
-    return render_template('services/browse.html', services=services, categories=categories)
+            url = url_for('services.browse', q=value)
+        suggestions.append({'text': label, 'type': kind, 'bookings': bookings, 'url': url})
+    
+    return jsonify({'query': prefix, 'suggestions': suggestions})
 
 @bp.route('/<int:service_id>')
 def detail(service_id):
@@ -103,37 +120,21 @@ def detail(service_id):
         flash('Service not found.', 'error')
         return redirect(url_for('services.browse'))
     
+    # Counted in memory and written in batches
+    record_view(service)
+    
     # Get category and provider information
     category = db.get_by_id('Service_Categories', service.get('category_id'))
     provider = db.get_by_id('Users', service.get('provider_id'))
     
-    # Get reviews for this service (exclude flagged reviews)
-    all_reviews = db.find_by_attribute('Reviews', 'provider_id', service.get('provider_id'))
-    reviews = [r for r in all_reviews if not r.get('is_flagged', False)]
-    
-    # Enrich reviews with user info
-    for review in reviews:
-        user = db.get_by_id('Users', review.get('user_id'))
-        review['user'] = user if user else {'name': 'Anonymous'}
-    
-    # Calculate average rating and review count
-    if reviews:
-        average_rating = sum(r['rating'] for r in reviews) / len(reviews)
-        review_count = len(reviews)
-    else:
-        average_rating = 0
-        review_count = 0
-    
-    # Calculate completed jobs
-    all_bookings = db.get_all("Bookings")
-    completed_jobs = len([b for b in all_bookings if b["provider_id"] == service.get("provider_id") and b["booking_status"] == "completed"])
+    # Rating, completed jobs and the rendered review list, cached per provider
+    provider_summary = current_app.provider_summaries.get(service.get('provider_id'))
     
     # Check if current user has an accepted/completed booking for this service
     user_has_booking = False
     if g.user and g.user.get('role') == 'user':
-        user_bookings = [b for b in all_bookings 
-                        if b.get('user_id') == g.user['id'] 
-                        and b.get('service_id') == service_id
+        user_bookings = [b for b in db.find_by_attribute('Bookings', 'user_id', g.user['id'])
+                        if b.get('service_id') == service_id
                         and b.get('booking_status') in ['accepted', 'completed']]
         user_has_booking = len(user_bookings) > 0
     
@@ -157,7 +158,9 @@ def detail(service_id):
             else:
                 flash('Book this service first to call the provider.', 'info')
     
-    return render_template('services/detail.html', service=service, reviews=reviews, average_rating=average_rating, review_count=review_count, completed_jobs=completed_jobs, user_has_booking=user_has_booking)
+    return render_template('services/detail.html', service=service, provider_summary=provider_summary,
+                           average_rating=provider_summary['average_rating'], review_count=provider_summary['review_count'],
+                           completed_jobs=provider_summary['completed_jobs'], user_has_booking=user_has_booking)
 
 @bp.route('/<int:service_id>/start-chat')
 @login_required
@@ -203,9 +206,7 @@ def manage():
     categories = db.get_all('Service_Categories')
     
     # Enrich services with category information
-    for service in services:
-        category = db.get_by_id('Service_Categories', service.get('category_id'))
-        service['category_name'] = category.get('category_name') if category else 'Unknown'
+    db.load_related(services, {'category_name': ('Service_Categories', 'category_id', 'category_name', 'Unknown')})
     
     return render_template('services/manage.html', services=services, categories=categories)
 
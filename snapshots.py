@@ -0,0 +1,200 @@
+"""Point-in-time snapshots of the JSON data directory.
+
+DataManager replaces table files on every write instead of rewriting them
+in place, so a table file never changes once written. A snapshot therefore
+only has to hard-link the current file of every table, which takes
+milliseconds whatever the table sizes. Tables whose file is the same one
+(same inode) as in the previous snapshot are recorded as unchanged, and
+shipping or restoring only copies the tables that changed.
+
+Creating and restoring a snapshot take the same per-table write locks
+as every DataManager writer, an flock shared by all processes using the
+data directory, so both are safe while the app is serving. Where fcntl is
+not available the locks only cover one process; stop the app first there.
+
+Layout of the backup directory::
+
+    <BACKUP_DIR>/<snapshot name>/manifest.json
+    <BACKUP_DIR>/<snapshot name>/<Table>.json
+"""
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+MANIFEST = 'manifest.json'
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Different filesystem (or no hard-link support): fall back to a copy
+        shutil.copy2(src, dst)
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _same_file(a, b):
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+def read_manifest(snapshot_dir):
+    with open(os.path.join(snapshot_dir, MANIFEST)) as f:
+        return json.load(f)
+
+def _write_manifest(snapshot_dir, manifest):
+    tmp_path = os.path.join(snapshot_dir, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, os.path.join(snapshot_dir, MANIFEST))
+
+def list_snapshots(backup_dir):
+    """Snapshot names in backup_dir, oldest first"""
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(name for name in os.listdir(backup_dir)
+                  if os.path.isfile(os.path.join(backup_dir, name, MANIFEST)))
+
+def create_snapshot(db, backup_dir):
+    """Freeze every table at one point in time and return the snapshot directory"""
+    os.makedirs(backup_dir, exist_ok=True)
+    previous = list_snapshots(backup_dir)
+    base_dir = os.path.join(backup_dir, previous[-1]) if previous else None
+    base_manifest = read_manifest(base_dir) if base_dir else {'tables': {}}
+
+    name = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    snapshot_dir = os.path.join(backup_dir, name)
+    os.makedirs(snapshot_dir)
+
+    table_names = db.table_names()
+    # Holding every table's write lock (shared with the web workers through
+    # flock) makes the set of files consistent; linking is a metadata
+    # operation, so writers wait only for a few milliseconds.
+    with db.lock_tables(table_names):
+        for table_name in table_names:
+            _link_or_copy(db._get_file_path(table_name), os.path.join(snapshot_dir, f'{table_name}.json'))
+
+    # Hashing happens on the frozen copies, outside the locks
+    tables = {}
+    changed = []
+    for table_name in table_names:
+        path = os.path.join(snapshot_dir, f'{table_name}.json')
+        base_entry = base_manifest['tables'].get(table_name)
+        if base_entry and _same_file(path, os.path.join(base_dir, f'{table_name}.json')):
+            tables[table_name] = base_entry
+        else:
+            tables[table_name] = {'size': os.path.getsize(path), 'sha256': _sha256(path)}
+            changed.append(table_name)
+
+    _write_manifest(snapshot_dir, {
+        'name': name,
+        'created_at': datetime.now().isoformat(),
+        'base': os.path.basename(base_dir) if base_dir else None,
+        'changed': changed,
+        'tables': tables
+    })
+    return snapshot_dir
+
+def ship_snapshot(snapshot_dir, target_dir):
+    """Copy a snapshot into another backup directory (e.g. a mounted backup volume).
+
+    Tables that are unchanged from the newest snapshot already in target_dir
+    are hard-linked there instead of copied, so only changed tables are sent.
+    """
+    manifest = read_manifest(snapshot_dir)
+    shipped = [name for name in list_snapshots(target_dir) if name < manifest['name']]
+    base_dir = os.path.join(target_dir, shipped[-1]) if shipped else None
+    base_tables = read_manifest(base_dir)['tables'] if base_dir else {}
+
+    dest_dir = os.path.join(target_dir, manifest['name'])
+    os.makedirs(dest_dir, exist_ok=True)
+    copied = []
+    for table_name, entry in manifest['tables'].items():
+        file_name = f'{table_name}.json'
+        dest = os.path.join(dest_dir, file_name)
+        if os.path.exists(dest):
+            continue
+        if base_tables.get(table_name, {}).get('sha256') == entry['sha256']:
+            _link_or_copy(os.path.join(base_dir, file_name), dest)
+        else:
+            shutil.copy2(os.path.join(snapshot_dir, file_name), dest)
+            copied.append(table_name)
+    _write_manifest(dest_dir, manifest)
+    return copied
+
+def restore_snapshot(db, snapshot_dir, tables=None):
+    """Put the data directory back to a snapshot; returns the tables that changed.
+
+    Only tables whose current contents differ from the snapshot are replaced.
+    Tables created after the snapshot are left alone. Writers wait while the
+    files are swapped; running caches pick the restored tables up through
+    their version check.
+    """
+    manifest = read_manifest(snapshot_dir)
+    selected = tables or list(manifest['tables'])
+
+    to_restore = []
+    for table_name in selected:
+        entry = manifest['tables'][table_name]
+        source = os.path.join(snapshot_dir, f'{table_name}.json')
+        if _sha256(source) != entry['sha256']:
+            raise ValueError(f"Snapshot {manifest['name']} is corrupt: checksum mismatch for {table_name}")
+        current = db._get_file_path(table_name)
+        if _same_file(source, current):
+            continue
+        if os.path.exists(current) and os.path.getsize(current) == entry['size'] and _sha256(current) == entry['sha256']:
+            continue
+        to_restore.append(table_name)
+
+    with db.lock_tables(to_restore):
+        for table_name in to_restore:
+            source = os.path.join(snapshot_dir, f'{table_name}.json')
+            with open(source, 'rb') as src:
+                db._replace_file(db._get_file_path(table_name), lambda f: shutil.copyfileobj(src, f))
+    return to_restore
+
+snapshot_cli = AppGroup('snapshot', help='Create, ship and restore data directory snapshots.')
+
+def _backup_dir():
+    return current_app.config['BACKUP_DIR']
+
+@snapshot_cli.command('create')
+def create_command():
+    """Snapshot all tables"""
+    snapshot_dir = create_snapshot(current_app.db, _backup_dir())
+    manifest = read_manifest(snapshot_dir)
+    click.echo(f"Created snapshot {manifest['name']} ({len(manifest['changed'])} changed table(s))")
+
+@snapshot_cli.command('list')
+def list_command():
+    """List snapshots"""
+    for name in list_snapshots(_backup_dir()):
+        manifest = read_manifest(os.path.join(_backup_dir(), name))
+        click.echo(f"{name}  changed: {', '.join(manifest['changed']) or '-'}")
+
+@snapshot_cli.command('ship')
+@click.argument('name')
+@click.argument('target_dir')
+def ship_command(name, target_dir):
+    """Copy snapshot NAME to TARGET_DIR, sending only changed tables"""
+    copied = ship_snapshot(os.path.join(_backup_dir(), name), target_dir)
+    click.echo(f"Shipped {name}: copied {', '.join(copied) or 'no tables'}")
+
+@snapshot_cli.command('restore')
+@click.argument('name')
+@click.option('--table', 'tables', multiple=True, help='Restore only this table (repeatable).')
+def restore_command(name, tables):
+    """Restore the data directory from snapshot NAME"""
+    restored = restore_snapshot(current_app.db, os.path.join(_backup_dir(), name), list(tables) or None)
+    click.echo(f"Restored {', '.join(restored) or 'nothing (already up to date)'}")
@@ -0,0 +1,162 @@
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is +Inf
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """Fixed-bucket histogram of durations in seconds"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimate a quantile (0..1) as the upper bound of the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.total, 6),
+            'max': round(self.max, 6),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets + ('+Inf',), self.counts)}
+        }
+
+class TableStats:
+    def __init__(self):
+        self.calls = {}
+        self.latency = {}
+        self.rows_scanned = 0
+        self.rows_returned = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.parse_time = Histogram()
+        self.dump_time = Histogram()
+        self.lock_wait = Histogram()
+        self.lock_hold = Histogram()
+
+    def to_dict(self):
+        return {
+            'calls': dict(self.calls),
+            'latency': {method: h.to_dict() for method, h in self.latency.items()},
+            'rows_scanned': self.rows_scanned,
+            'rows_returned': self.rows_returned,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'parse_time': self.parse_time.to_dict(),
+            'dump_time': self.dump_time.to_dict(),
+            'lock_wait': self.lock_wait.to_dict(),
+            'lock_hold': self.lock_hold.to_dict()
+        }
+
+class StatsWindow:
+    """Per-table, per-cache and identity map counters since the window started"""
+
+    def __init__(self):
+        self.tables = {}
+        self.caches = {}
+        self.identity_map = {'requests': 0, 'hits': 0, 'misses': 0}
+
+    def table(self, table_name):
+        if table_name not in self.tables:
+            self.tables[table_name] = TableStats()
+        return self.tables[table_name]
+
+    def to_dict(self):
+        caches = {}
+        for name, counts in self.caches.items():
+            lookups = counts['hits'] + counts['misses']
+            caches[name] = dict(counts, hit_ratio=round(counts['hits'] / lookups, 4) if lookups else None)
+        return {
+            'tables': {name: stats.to_dict() for name, stats in sorted(self.tables.items())},
+            'caches': caches,
+            'identity_map': dict(self.identity_map)
+        }
+
+class StorageStats:
+    """Per-table counters and timings for a DataManager (per process).
+
+    Everything is counted twice: in ``totals``, which only ever grows and
+    backs the Prometheus counters (metrics.py), and in ``current``, which
+    the admin storage stats page can reset without making those go back.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = StatsWindow()
+        self.current = StatsWindow()
+
+    def record_call(self, table_name, method, elapsed, scanned, returned):
+        with self.lock:
+            for window in (self.current, self.totals):
+                stats = window.table(table_name)
+                stats.calls[method] = stats.calls.get(method, 0) + 1
+                stats.latency.setdefault(method, Histogram()).observe(elapsed)
+                stats.rows_scanned += scanned
+                stats.rows_returned += returned
+
+    def record_read(self, table_name, size, parse, wait, hold):
+        with self.lock:
+            for window in (self.current, self.totals):
+                stats = window.table(table_name)
+                stats.bytes_read += size
+                stats.parse_time.observe(parse)
+                stats.lock_wait.observe(wait)
+                stats.lock_hold.observe(hold)
+
+    def record_write(self, table_name, size, dump, wait, hold):
+        with self.lock:
+            for window in (self.current, self.totals):
+                stats = window.table(table_name)
+                stats.bytes_written += size
+                stats.dump_time.observe(dump)
+                stats.lock_wait.observe(wait)
+                stats.lock_hold.observe(hold)
+
+    def record_cache(self, cache_name, hit):
+        with self.lock:
+            for window in (self.current, self.totals):
+                counts = window.caches.setdefault(cache_name, {'hits': 0, 'misses': 0})
+                counts['hits' if hit else 'misses'] += 1
+
+    def record_dedup(self, hits, misses):
+        """Lookups answered by (hits) or passed through (misses) a request's identity map"""
+        with self.lock:
+            for window in (self.current, self.totals):
+                window.identity_map['requests'] += 1
+                window.identity_map['hits'] += hits
+                window.identity_map['misses'] += misses
+
+    def snapshot(self, totals=False):
+        """JSON-serialisable copy of the counters since the last reset (or since start, with totals)"""
+        with self.lock:
+            return (self.totals if totals else self.current).to_dict()
+
+    def reset(self):
+        """Restart the counters shown on the admin page; totals keep counting"""
+        with self.lock:
+            self.current = StatsWindow()
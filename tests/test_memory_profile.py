@@ -0,0 +1,29 @@
+from data_manager import DataManager, TableCache
+from memory_profile import cache_footprints, deep_sizeof
+
+class Source(TableCache):
+    tables = ('Services',)
+
+    def __init__(self, db):
+        super().__init__(db)
+        self.rows = [str(i) * 1000 for i in range(100)]
+
+class Derived(TableCache):
+    tables = ('Services',)
+
+    def __init__(self, db, source):
+        super().__init__(db)
+        self.source = source
+        self.ids = [1, 2, 3]
+
+def test_deep_sizeof_skips_excluded_objects():
+    shared = ['x' * 1000]
+    assert deep_sizeof({'a': shared}, exclude=[shared]) < deep_sizeof({'a': shared}) - 1000
+
+def test_cache_footprint_leaves_out_referenced_caches(tmp_path):
+    db = DataManager(str(tmp_path))
+    source = Source(db)
+    Derived(db, source)
+    footprints = {f['cache']: f['memory_bytes'] for f in cache_footprints(db)}
+    assert footprints['Source'] > 100 * 1000
+    assert footprints['Derived'] < 10 * 1000
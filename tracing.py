@@ -0,0 +1,235 @@
+"""Sampled per-request span trees, written as OTLP/JSON lines.
+
+A sampled request (TRACE_SAMPLE_RATE, or an incoming W3C ``traceparent``
+header with the sampled flag when TRACE_TRUST_PARENT is set) gets a root
+span. Nested inside it are spans for the view function, each DataManager
+call (table, method and row counts) and each template render. Code can
+add its own spans with::
+
+    with tracing.span('build_stats', provider_id=provider_id):
+        ...
+
+which costs nothing for requests that aren't sampled. Each trace is
+appended as one line to TRACE_DIR/traces-<date>-<pid>.jsonl in the
+OTLP/JSON "resourceSpans" shape, so the OpenTelemetry collector's file
+receiver, otel-desktop-viewer or jq can read it. Files older than
+TRACE_RETENTION_DAYS are deleted when a worker starts a new day's file.
+"""
+import contextlib
+import functools
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import before_render_template, current_app, g, has_request_context, request, template_rendered
+
+SERVICE_NAME = 'neeget'
+
+# OTLP span kinds and status codes
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+_TRACE_FILE = re.compile(r'^traces-(\d{8})-\d+\.jsonl$')
+
+_write_lock = threading.Lock()
+# Day this process last pruned old trace files on
+_pruned_day = None
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+class Trace:
+    def __init__(self, trace_id=None, parent_span_id=''):
+        self.trace_id = trace_id or f'{random.getrandbits(128):032x}'
+        self.spans = []
+        self.stack = []
+        self.remote_parent = parent_span_id
+
+    def start_span(self, name, kind=KIND_INTERNAL, start_ns=None, **attributes):
+        parent = self.stack[-1]['spanId'] if self.stack else self.remote_parent
+        span = {
+            'traceId': self.trace_id,
+            'spanId': f'{random.getrandbits(64):016x}',
+            'parentSpanId': parent,
+            'name': name,
+            'kind': kind,
+            'startTimeUnixNano': start_ns or time.time_ns(),
+            'endTimeUnixNano': None,
+            'attributes': attributes,
+            'status': {'code': STATUS_UNSET}
+        }
+        self.spans.append(span)
+        self.stack.append(span)
+        return span
+
+    def end_span(self, span, error=None):
+        span['endTimeUnixNano'] = time.time_ns()
+        if error is not None:
+            span['status'] = {'code': STATUS_ERROR, 'message': repr(error)}
+        if span in self.stack:
+            # Also closes any children left open (e.g. a render that raised)
+            del self.stack[self.stack.index(span):]
+
+    def add_span(self, name, start_ns, end_ns, kind=KIND_INTERNAL, **attributes):
+        """Record an already finished span under the currently open one"""
+        span = self.start_span(name, kind, start_ns, **attributes)
+        self.stack.pop()
+        span['endTimeUnixNano'] = end_ns
+
+    def to_otlp(self):
+        spans = []
+        for span in self.spans:
+            span = dict(span, attributes=[_attribute(k, v) for k, v in span['attributes'].items()])
+            span['startTimeUnixNano'] = str(span['startTimeUnixNano'])
+            span['endTimeUnixNano'] = str(span['endTimeUnixNano'] or time.time_ns())
+            spans.append(span)
+        return {'resourceSpans': [{
+            'resource': {'attributes': [_attribute('service.name', SERVICE_NAME),
+                                        _attribute('process.pid', os.getpid())]},
+            'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': spans}]
+        }]}
+
+def current_trace():
+    if not has_request_context():
+        return None
+    return g.get('trace')
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Time a block as a child of the current span (no-op when not sampled)"""
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, **attributes)
+    try:
+        yield current
+    except BaseException as e:
+        trace.end_span(current, error=e)
+        raise
+    else:
+        trace.end_span(current)
+
+def _db_span(table_name, method, elapsed, scanned, returned):
+    trace = current_trace()
+    if trace is not None:
+        end = time.time_ns()
+        trace.add_span(f'{method} {table_name}', end - int(elapsed * 1e9), end, KIND_CLIENT,
+                       **{'db.system': 'json', 'db.sql.table': table_name, 'db.operation': method,
+                          'db.rows_scanned': scanned, 'db.rows_returned': returned})
+
+def _render_started(sender, template, context, **extra):
+    trace = current_trace()
+    if trace is not None:
+        trace.start_span(f'render {template.name}', **{'template.name': template.name})
+
+def _render_finished(sender, template, context, **extra):
+    trace = current_trace()
+    if trace is not None and trace.stack and trace.stack[-1]['name'] == f'render {template.name}':
+        trace.end_span(trace.stack[-1])
+
+def _traced_view(endpoint, view):
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        with span(f'view {endpoint}', **{'code.function': view.__name__}):
+            return view(*args, **kwargs)
+    return wrapped
+
+def trace_views(app):
+    """Give every registered view function its own span; call once all routes exist"""
+    for endpoint, view in list(app.view_functions.items()):
+        if endpoint != 'static':
+            app.view_functions[endpoint] = _traced_view(endpoint, view)
+
+def prune_traces(trace_dir, retention_days):
+    """Delete the trace files of days more than retention_days ago"""
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y%m%d')
+    for filename in os.listdir(trace_dir):
+        match = _TRACE_FILE.match(filename)
+        if match and match.group(1) < cutoff:
+            try:
+                os.remove(os.path.join(trace_dir, filename))
+            except FileNotFoundError:
+                # Another worker pruned it first
+                pass
+
+def export(trace_dir, trace, retention_days=None):
+    global _pruned_day
+    os.makedirs(trace_dir, exist_ok=True)
+    day = datetime.now().strftime('%Y%m%d')
+    path = os.path.join(trace_dir, f"traces-{day}-{os.getpid()}.jsonl")
+    line = json.dumps(trace.to_otlp(), separators=(',', ':'))
+    with _write_lock:
+        if retention_days is not None and _pruned_day != day:
+            prune_traces(trace_dir, retention_days)
+            _pruned_day = day
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+
+def _sampled_parent():
+    """(trace_id, parent_span_id) for this request, or None if it isn't sampled.
+
+    A sampled trace joins the caller's trace id, but the caller's sampled
+    flag only forces a trace when TRACE_TRUST_PARENT is set; otherwise any
+    client could make every request write a trace to disk.
+    """
+    match = _TRACEPARENT.match(request.headers.get('traceparent', ''))
+    parent = (match.group(1), match.group(2)) if match else (None, '')
+    if match and int(match.group(3), 16) & 1 and current_app.config.get('TRACE_TRUST_PARENT', False):
+        return parent
+    if random.random() < current_app.config.get('TRACE_SAMPLE_RATE', 0.0):
+        return parent
+    return None
+
+def init_app(app):
+    app.db.call_hooks.append(_db_span)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+
+    @app.before_request
+    def start_trace():
+        parent = _sampled_parent()
+        if parent is None:
+            return
+        g.trace = Trace(*parent)
+        g.trace_root = g.trace.start_span(f'{request.method} {request.url_rule or request.path}', KIND_SERVER, **{
+            'http.method': request.method,
+            'http.target': request.full_path.rstrip('?'),
+            'http.route': str(request.url_rule or ''),
+            'flask.endpoint': request.endpoint or ''
+        })
+
+    @app.after_request
+    def tag_response(response):
+        trace = g.get('trace')
+        if trace is not None:
+            g.trace_root['attributes']['http.status_code'] = response.status_code
+            if g.get('user'):
+                g.trace_root['attributes']['enduser.id'] = g.user['id']
+            response.headers['traceparent'] = f"00-{trace.trace_id}-{g.trace_root['spanId']}-01"
+        return response
+
+    @app.teardown_request
+    def finish_trace(exc):
+        trace = g.pop('trace', None)
+        if trace is None:
+            return
+        trace.end_span(g.pop('trace_root'), error=exc)
+        try:
+            export(current_app.config['TRACE_DIR'], trace, current_app.config.get('TRACE_RETENTION_DAYS'))
+        except OSError:
+            current_app.logger.exception('Could not write trace %s', trace.trace_id)
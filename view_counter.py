@@ -0,0 +1,134 @@
+"""Service page view counts without a table write per view.
+
+Each worker counts views in memory per (service, day) and adds the
+accumulated deltas to the Service_Views table (one row per service and
+day with views) in a single write at most every VIEW_FLUSH_INTERVAL
+seconds, and once more when the process exits. Flushes run after requests
+and from a background thread, so an idle worker doesn't sit on its
+counts; DataManager.add_counts holds the table's cross-process write lock,
+so workers flushing together don't lose each other's increments. Totals
+read back from the table are kept per service and day, and this worker's
+unflushed views are added on top, so a provider sees their own visits
+straight away.
+"""
+import atexit
+import os
+import threading
+import time
+from datetime import date, timedelta
+
+from flask import current_app, g
+
+from data_manager import TableCache
+
+class ViewCounter(TableCache):
+    tables = ('Service_Views',)
+
+    def __init__(self, db, flush_interval, logger=None):
+        super().__init__(db)
+        self.flush_interval = flush_interval
+        self.logger = logger
+        self.pending_lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._flusher_pid = None
+        self._totals = {}
+        self._daily = {}
+
+    def record(self, service_id):
+        key = (service_id, date.today().isoformat())
+        with self.pending_lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+            if self._flusher_pid != os.getpid():
+                # Started on first use, so every (forked) worker runs its own
+                self._flusher_pid = os.getpid()
+                threading.Thread(target=self._flush_periodically, name='view-counter-flush', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception('Could not write service views')
+
+    def pending(self):
+        """Views counted by this worker and not yet written"""
+        with self.pending_lock:
+            return sum(self._pending.values())
+
+    def flush(self, force=False):
+        """Write the pending views (throttled unless forced)"""
+        with self.pending_lock:
+            if not self._pending or (not force and time.monotonic() - self._last_flush < self.flush_interval):
+                return
+            deltas, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        try:
+            self.db.add_counts('Service_Views', ('service_id', 'date'), deltas, field='views')
+        except Exception:
+            # Keep the views for the next attempt
+            with self.pending_lock:
+                for key, views in deltas.items():
+                    self._pending[key] = self._pending.get(key, 0) + views
+            raise
+
+    def stats(self, service_ids, days=7):
+        """{service_id: {'total': views, 'recent': views in the last days days}}"""
+        since = (date.today() - timedelta(days=days - 1)).isoformat()
+        with self.pending_lock:
+            pending = list(self._pending.items())
+        self.ensure_fresh()
+        with self.lock:
+            result = {}
+            for service_id in service_ids:
+                daily = self._daily.get(service_id, {})
+                result[service_id] = {
+                    'total': self._totals.get(service_id, 0),
+                    'recent': sum(views for day, views in daily.items() if day >= since)
+                }
+        for (service_id, day), views in pending:
+            if service_id in result:
+                result[service_id]['total'] += views
+                if day >= since:
+                    result[service_id]['recent'] += views
+        return result
+
+    def _rebuild(self):
+        self._totals = {}
+        self._daily = {}
+        for row in self.db.get_all('Service_Views'):
+            self._count(row, 1)
+
+    def _apply(self, table_name, action, item, previous):
+        if previous is not None:
+            self._count(previous, -1)
+        self._count(item, -1 if action == 'delete' else 1)
+        return True
+
+    def _count(self, row, sign):
+        service_id, views = row.get('service_id'), sign * row.get('views', 0)
+        self._totals[service_id] = self._totals.get(service_id, 0) + views
+        daily = self._daily.setdefault(service_id, {})
+        daily[row.get('date')] = daily.get(row.get('date'), 0) + views
+
+def init_app(app):
+    app.view_counter = ViewCounter(app.db, app.config.get('VIEW_FLUSH_INTERVAL', 30.0), app.logger)
+    app.metrics.register_gauge('service_views_pending', 'Service page views counted but not yet written',
+                               app.view_counter.pending)
+    atexit.register(app.view_counter.flush, force=True)
+
+    @app.after_request
+    def flush_views(response):
+        try:
+            current_app.view_counter.flush()
+        except Exception:
+            current_app.logger.exception('Could not write service views')
+        return response
+
+def record_view(service):
+    """Count a view of service, unless its own provider is looking"""
+    if g.user and g.user.get('id') == service.get('provider_id'):
+        return
+    current_app.view_counter.record(service['id'])